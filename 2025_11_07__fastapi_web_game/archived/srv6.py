@@ -1,5 +1,5 @@
 """
-To run:
+To run (dependencies are in requirements.txt):
     fastapi dev srv5.py
 
 Summary:
@@ -10,7 +10,9 @@ Summary:
 Game loop
 ---------
 
-`game_loop` calls `trigger_tick` `_fps` times per second.
+`game_loop` calls `trigger_tick` `_fps` times per second,
+on fixed deadlines (see `_fixed_rate_loop`), and records
+timings in `_tickstats`, which are served on `/metrics`.
 The current frames per second:
 >>> _fps
 30
@@ -30,15 +32,19 @@ First, we create a Connection Manager (`_ConnMgr`) to handle all clients.
 >>> cm = _ConnMgr(debug=True)
 
 When a new client joins, `ws_setup` is called once.  
-It immediately sends the static entities to that client:
+It immediately tells that client which version of the static entities to
+fetch from `/static/{version}` (see `getstatic`):
 >>> proc, discon = cm.ws_setup(fake_websocket_send, verbose=True)
-send: {"static": {}}
+send: {"static_version": "..."}
 
 The dynamic entities and players are sent on each tick.
 Ticks also change the game state and send data to the client.
+The first tick a client gets is a keyframe with everything in it.
+Each tick has a sequence number, and the server time in ms ("t"), for clients to
+interpolate between ticks.
 In this doctest session, there are currently no players.
 >>> cm.trigger_tick()
-send: {"dynamic": {}, "players": {}}
+send: {"frame": "key", "seq": 1, "t": ..., "dynamic": {}, "players": {}}
 
 When the client sends an event, we process it using `proc`.
 In this case, we are pretending that the client is sending
@@ -48,17 +54,21 @@ an "init" event, which it should send once upon joining.
 proc: CliEvent(cid='...', payload_raw='{"eventkind": "init"...}')
 
 The game state will reflect that a client has joined, because
-the `players` dict now has an element:
+the `players` dict now has an element. After the first tick, clients
+only get a patch containing what changed. The "ack" says this tick reflects
+the first message the client sent (see `_InputAcks`):
 >>> cm.trigger_tick()
-send: {"dynamic": {}, "players": {"...": {"x": ..., "y": ...}}}
+send: {"ack": 1, "frame": "patch", "seq": 2, "t": ..., "dynamic": {}, "players": {"...": {"x": ..., "y": ...}}}
 
-We eventually disconnect:
+If nothing changed, nothing is sent:
+>>> cm.trigger_tick()
+
+We eventually disconnect. Like other events, the disconnect is queued,
+and applied on the next tick. After that, ticks no longer send data to that client:
 >>> discon()
 proc: Disconnect(cid='...')
-I: Removing ... from dict
-
-After disconnecting, ticks no longer send data to that client:
 >>> cm.trigger_tick()
+I: Removing ... from dict
 
 ---------
 
@@ -71,60 +81,542 @@ called in `websocket_endpoint_impl`. Here's a demo doctest:
 >>> async def async_fake_websocket_recv():
 ...     return '{"eventkind": "init", "name": "abc", "avatar": "/assets/somefile.png"}'
 
-In the example below, the removal appears to be happening before the intial send.
-Someday we may figure out how to avoid this race condition, but for now, it's probably
-ok because most players aren't going to exit the game immediately after connecting.
+In the example below, no tick happens while the client is connected, so its
+events (the second init is a repeat, so it's dropped) and its disconnect all
+wait for the next tick:
 >>> asyncio.run(cm.websocket_endpoint_impl(async_fake_websocket_send, async_fake_websocket_recv, max_rcv_msgs=2))
+async send: {"static_version": "..."}
+>>> cm.trigger_tick()
 I: Removing ... from dict
-async send: {"static": {}}
 """
 
 
 import asyncio
+import bisect
+from collections import deque
 from contextlib import asynccontextmanager
+import cProfile
+import io
+import json
+import pstats
 import random
 import string
-from typing import Callable
+import time
+from typing import Callable, Literal
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
-from rx.subject import Subject
 
-from srv6_helper import GameState, CliEvent, Disconnect
+from srv6_helper import GameState, CliEvent, Disconnect, TickFrames, AreaOfInterest, BadPayload, Spans, StaticLayer, with_ack
+from srv6_replay import Recorder
+from srv6_shards import ShardedGameState
 
 
 
 @asynccontextmanager
 async def _lifespan(app: FastAPI):
     async def game_loop():
+        await _fixed_rate_loop(_connmgr.trigger_tick, _fps, _tickstats)
+    async def log_spans():
         while True:
-            await asyncio.sleep(1 / _fps)
-            _connmgr.trigger_tick()
+            await asyncio.sleep(_spans_log_every)
+            print("I: tick phases", _connmgr.spans.todict())
     asyncio.create_task(game_loop())
+    if _spans_log_every:
+        asyncio.create_task(log_spans())
     yield
+    _connmgr.close()
+
+
+class _TickStats:
+    """Tick timings, for `/metrics`."""
+    BUCKETS_MS = (1, 2, 5, 10, 20, 33, 50, 100)
+    """Upper bounds of the tick duration histogram buckets"""
+
+    def __init__(self, fps: int):
+        self.fps = fps
+        self.ticks = 0
+        self.busy = 0.0
+        """total seconds spent in ticks"""
+        self.overruns = 0
+        """ticks that took longer than 1 / fps"""
+        self.skipped = 0
+        """ticks that were dropped because the loop fell too far behind"""
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+        self.__starts: "deque[float]" = deque(maxlen=fps * 5)
+
+    def record(self, started: float, duration: float):
+        self.ticks += 1
+        self.busy += duration
+        if duration > 1 / self.fps:
+            self.overruns += 1
+        self.histogram[bisect.bisect_left(self.BUCKETS_MS, duration * 1000)] += 1
+        self.__starts.append(started)
+
+    def achieved_hz(self) -> float:
+        """Tick rate over the last few seconds"""
+        if len(self.__starts) < 2:
+            return 0.0
+        return (len(self.__starts) - 1) / (self.__starts[-1] - self.__starts[0])
+
+    def todict(self):
+        labels = [f"le_{b}ms" for b in self.BUCKETS_MS] + ["inf"]
+        return {
+            "target_hz": self.fps,
+            "achieved_hz": round(self.achieved_hz(), 2),
+            "ticks": self.ticks,
+            "mean_ms": round(self.busy / max(self.ticks, 1) * 1000, 3),
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "duration_histogram": dict(zip(labels, self.histogram)),
+        }
+
+
+async def _fixed_rate_loop(tick: Callable, fps: int, stats: _TickStats, max_catchup = 3,
+                           clock = time.monotonic, sleep = asyncio.sleep, max_ticks = int(10e18)):
+    """Call `tick` on deadlines `1 / fps` apart, however long each tick takes.
+    If a tick runs late, the following ticks run back-to-back to catch up. If the loop
+    falls more than `max_catchup` ticks behind, the missed ticks are skipped instead.
+
+    Demo with a fake clock, where the 3rd tick takes as long as 10 ticks should:
+    >>> now = 0.0
+    >>> async def fake_sleep(s):
+    ...     global now
+    ...     now += s
+    >>> def fake_tick():
+    ...     global now
+    ...     now += 10 / 30 if stats.ticks == 2 else 0.001
+    >>> stats = _TickStats(30)
+    >>> asyncio.run(_fixed_rate_loop(fake_tick, 30, stats, clock=lambda: now, sleep=fake_sleep, max_ticks=20))
+    >>> stats.ticks, stats.overruns, stats.skipped
+    (20, 1, 9)
+
+    The loop stays on the 1/30 s grid: 29 periods (20 ticks + 9 skipped),
+    plus the last tick's 1 ms:
+    >>> round(now, 3)
+    0.968
+    """
+    period = 1 / fps
+    deadline = clock()
+    for _i in range(max_ticks):
+        deadline += period
+        delay = deadline - clock()
+        # Yield even when late, so websocket sends and receives still get to run.
+        await sleep(max(delay, 0))
+        behind = clock() - deadline
+        if behind > max_catchup * period:
+            missed = int(behind / period)
+            stats.skipped += missed
+            deadline += missed * period
+        started = clock()
+        tick()
+        stats.record(started, clock() - started)
+
+
+class _TickHub:
+    """Hands the latest `TickFrames` to every client's writer.
+
+    `publish` bumps `version`, keeps the frames, and resolves one future per writer
+    waiting for that version (see `_Outbox.run`), so it's still O(clients), but does
+    no rendering or sending itself. Each writer then renders whatever is newest, so a
+    writer that's still busy sending skips the versions in between, and writers for
+    clients with a lower update rate aren't waiting on the versions they skip. The frames are shared, and `TickFrames` encodes each patch only once,
+    however many clients send it.
+
+    Connections without a writer (as in the module doctest) can `subscribe` a callback
+    instead, which is called on each `publish`.
+    """
+    def __init__(self):
+        self.version = 0
+        self.frames: "TickFrames | None" = None
+        self.__waiters: "dict[int, list[asyncio.Future]]" = {}
+        """version -> futures to wake when it's published"""
+        self.__callbacks: "dict[int, Callable[[TickFrames], None]]" = {}
+        self.__next_key = 0
+
+    def publish(self, frames: TickFrames):
+        self.frames = frames
+        self.version += 1
+        for fut in self.__waiters.pop(self.version, []):
+            if not fut.done():
+                fut.set_result(None)
+        for callback in list(self.__callbacks.values()):
+            callback(frames)
+
+    def waiter(self, version: int) -> asyncio.Future:
+        """A future that's done when `version` (a future version) is published."""
+        fut = asyncio.get_running_loop().create_future()
+        self.__waiters.setdefault(version, []).append(fut)
+        return fut
+
+    def subscribe(self, callback: "Callable[[TickFrames], None]") -> Callable:
+        """Call `callback(frames)` on each `publish`. Returns a function that unsubscribes."""
+        key, self.__next_key = self.__next_key, self.__next_key + 1
+        self.__callbacks[key] = callback
+        return lambda: self.__callbacks.pop(key, None)
+
+
+class _Outbox:
+    """Outgoing messages for one client, sent in order by a single writer coroutine (`run`).
+
+    Tick frames aren't queued: once it `follow`s a `_TickHub`, the writer renders the
+    newest version whenever it's ready to send. A client that falls behind skips the stale
+    ticks (counted in `dropped`) instead of piling up pending sends.
+
+    Clients are sent every `every` ticks (see `set_every`), on the versions that are
+    multiples of it, so that clients at the same rate get the same patches (which
+    `TickFrames` encodes once). While a client's sends can't keep up, the writer backs off
+    further, up to `MAX_BACKOFF` ticks apart.
+
+    >>> async def demo():
+    ...     sent = []
+    ...     async def slow_send(x):
+    ...         await asyncio.sleep(0.01)
+    ...         sent.append(x)
+    ...     hub = _TickHub()
+    ...     ob = _Outbox(slow_send)
+    ...     ob.follow(hub, lambda frames: [f"tick{frames}"])
+    ...     writer = asyncio.create_task(ob.run())
+    ...     ob.put("static")
+    ...     for i in range(5):
+    ...         hub.publish(i)
+    ...     ob.close()
+    ...     await writer
+    ...     return sent, ob.dropped
+    >>> asyncio.run(demo())
+    (['static', 'tick4'], 4)
+
+    Every 3rd tick:
+    >>> async def demo():
+    ...     sent = []
+    ...     async def send(x):
+    ...         sent.append(x)
+    ...     hub = _TickHub()
+    ...     ob = _Outbox(send)
+    ...     ob.follow(hub, lambda frames: [f"tick{frames}"])
+    ...     ob.set_every(3)
+    ...     writer = asyncio.create_task(ob.run())
+    ...     for i in range(1, 8):
+    ...         hub.publish(i)
+    ...         await asyncio.sleep(0)
+    ...     ob.close()
+    ...     await writer
+    ...     return sent, ob.dropped
+    >>> asyncio.run(demo())
+    (['tick1', 'tick3', 'tick6'], 0)
+    """
+    MAX_BACKOFF = 30
+    RECOVER_AFTER = 10
+    """sends in time before halving the back-off"""
+
+    def __init__(self, websocket_send: Callable, maxsize = 16):
+        """`maxsize` bounds the non-tick messages waiting to be sent."""
+        self.__send = websocket_send
+        self.__msgs: "deque[str | bytes]" = deque()
+        self.__maxsize = maxsize
+        self.__hub: "_TickHub | None" = None
+        self.__render: "Callable[[TickFrames], list[str | bytes]] | None" = None
+        self.__seen = 0
+        """the hub version this client was last sent"""
+        self.__due = 1
+        """the hub version to send next"""
+        self.every = 1
+        self.backoff = 1
+        self.__in_time = 0
+        self.__waiting: "asyncio.Future | None" = None
+        self.__closed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def follow(self, hub: _TickHub, render: "Callable[[TickFrames], list[str | bytes]]"):
+        """Send each new version from `hub`. `render(frames)` returns the messages to send."""
+        self.__hub = hub
+        self.__render = render
+        self.__seen = hub.version
+        self.__due = hub.version + 1
+        self.__wake()
+
+    def set_every(self, every: int):
+        """Send every `every` ticks from now on. If that makes an update due sooner
+        than planned, it's sent with the next tick at the latest."""
+        self.every = every
+        due = self.__next_due()
+        if due < self.__due:
+            self.__due = due if self.__hub is None else max(due, self.__hub.version + 1)
+            self.__wake()
+
+    def put(self, msg: "str | bytes"):
+        """Queue a message that must not be skipped. If the queue is full, `msg` is dropped."""
+        if len(self.__msgs) >= self.__maxsize:
+            self.dropped += 1
+            return
+        self.__msgs.append(msg)
+        self.__wake()
+
+    def close(self):
+        """Stop `run` once everything already queued has been sent."""
+        self.__closed = True
+        self.__wake()
+
+    def __next_due(self) -> int:
+        every = max(self.every, self.backoff)
+        return (self.__seen // every + 1) * every
+
+    def __pace(self, published_while_sending: int):
+        """Back off while sending one update takes longer than the time until the next"""
+        if published_while_sending >= max(self.every, self.backoff):
+            self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+            self.__in_time = 0
+        elif self.backoff > 1:
+            self.__in_time += 1
+            if self.__in_time >= self.RECOVER_AFTER:
+                self.backoff //= 2
+                self.__in_time = 0
+
+    def __wake(self):
+        if self.__waiting is not None and not self.__waiting.done():
+            self.__waiting.set_result(None)
+
+    async def run(self):
+        while True:
+            while self.__msgs:
+                await self.__send(self.__msgs.popleft())
+                self.sent += 1
+            hub = self.__hub
+            if hub is not None and hub.version >= self.__due:
+                self.dropped += hub.version - self.__due
+                self.__seen = hub.version
+                for msg in self.__render(hub.frames):  # type: ignore
+                    await self.__send(msg)
+                    self.sent += 1
+                self.__pace(hub.version - self.__seen)
+                self.__due = self.__next_due()
+                if not self.__closed:
+                    continue
+            if self.__closed and not self.__msgs:
+                return
+            if self.__msgs:
+                continue
+            self.__waiting = hub.waiter(self.__due) if hub is not None else asyncio.get_running_loop().create_future()
+            await self.__waiting
+            self.__waiting = None
+
+
+class _UpdateRate:
+    """How many ticks apart one client's updates should be: every tick while its player
+    is moving, a player near it is moving, or it has just sent something; `IDLE_EVERY`
+    ticks otherwise (including before it has a player). See `_Outbox.set_every`.
+    >>> frames = TickFrames()
+    >>> frames.push({"dynamic": {}, "players": {"a": {"x": 0, "y": 0, "change_x": 0, "change_y": 0},
+    ...                                         "b": {"x": 5000, "y": 0, "change_x": 50, "change_y": 0}}})
+    >>> rate = _UpdateRate("a")
+    >>> rate.every(frames)
+    6
+
+    Input counts as activity for a while:
+    >>> rate.received(frames.seq)
+    >>> rate.every(frames)
+    1
+    >>> frames.seq += rate.INPUT_TICKS
+    >>> rate.every(frames)
+    6
+    """
+    IDLE_EVERY = 6
+    """5 Hz at 30 ticks per second"""
+    INPUT_TICKS = 30
+    """ticks after a client's last message that it counts as active"""
+    NEAR = 600
+    """px. Players moving further away than this don't make a client active."""
+
+    def __init__(self, cid: str):
+        self.cid = cid
+        self.__last_input: "int | None" = None
+
+    def received(self, tick_seq: int):
+        """Call on each message from the client"""
+        self.__last_input = tick_seq
+
+    def every(self, frames: TickFrames) -> int:
+        if self.__last_input is not None and frames.seq - self.__last_input < self.INPUT_TICKS:
+            return 1
+        me = frames.player(self.cid)
+        if me is None:
+            return self.IDLE_EVERY
+        if frames.moving_near(me["x"], me["y"], self.NEAR, self.NEAR):
+            return 1
+        return self.IDLE_EVERY
+
+
+class _InputAcks:
+    """Which of one client's messages each tick reflects, so the client can tell which of its
+    inputs the server has seen (and predict the rest itself).
+
+    Messages are counted from 1 in the order they arrive. Websockets keep the order, so
+    the client counts what it sends the same way, and the messages don't need numbering.
+    Every message received before a tick starts is applied, or dropped, by that tick.
+    >>> acks = _InputAcks()
+    >>> acks.received(0); acks.received(0)
+    >>> acks.acked(0), acks.acked(1)
+    (0, 2)
+    >>> acks.received(1)
+    >>> acks.acked(1), acks.acked(2)
+    (2, 3)
+    """
+    def __init__(self):
+        self.count = 0
+        self.__pending = (0, 0)
+        """(first tick to reflect them, `count` then), for the latest messages"""
+        self.__acked = 0
+
+    def received(self, tick_seq: int):
+        """Call on each message from the client. `tick_seq` is the latest tick so far."""
+        self.count += 1
+        self.__settle(tick_seq)
+        self.__pending = (tick_seq + 1, self.count)
+
+    def acked(self, tick_seq: int) -> int:
+        """How many messages tick `tick_seq` reflects (the latest tick so far)"""
+        self.__settle(tick_seq)
+        return self.__acked
+
+    def __settle(self, tick_seq: int):
+        tick, count = self.__pending
+        if tick <= tick_seq:
+            self.__acked = count
+
+
+class _ProfileCapture:
+    """cProfile over a fixed number of ticks. See `_ConnMgr.profile_ticks`."""
+    def __init__(self, nticks: int, filename: str):
+        self.profiler = cProfile.Profile()
+        self.remaining = nticks
+        self.filename = filename
+        self.done: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+
+    def count_tick(self) -> bool:
+        """Call after each profiled tick. Returns True, and finishes up, after the last one."""
+        self.remaining -= 1
+        if self.remaining > 0:
+            return False
+        self.profiler.dump_stats(self.filename)
+        report = io.StringIO()
+        pstats.Stats(self.profiler, stream=report).sort_stats("cumulative").print_stats(30)
+        if not self.done.done():
+            self.done.set_result(report.getvalue())
+        return True
 
 
 class _ConnMgr:
-    def __init__(self, debug=False):
-        """`debug` is passed to GameState init"""
-        self.__gs = GameState(create_entities=not debug)
-        self.__tickresult = Subject()
+    def __init__(self, debug=False, shards=0, mapfile="map.txt", spawns: "list[tuple[int, int]] | None" = None,
+                 record: "str | None" = None, adaptive_rates = True):
+        """`debug`, `mapfile` and `spawns` are passed to GameState init.
+        With `shards` > 0, the world is split across that many worker processes (see srv6_shards.py).
+        With `record`, every client event is written to that file (see srv6_replay.py).
+        With `adaptive_rates`, quiet clients get fewer updates (see `_UpdateRate`)."""
+        self.adaptive_rates = adaptive_rates
+        self.spans = Spans()
+        """Phase timings for this and the GameState. Set `spans.enabled` to start timing."""
+        self.__gs: "GameState | ShardedGameState"
+        if shards:
+            self.__gs = ShardedGameState(shards, mapfile=None if debug else mapfile, spawns=spawns)
+        else:
+            self.__gs = GameState(create_entities=not debug, mapfile=mapfile, spawns=spawns, spans=self.spans)
+        self.__frames = TickFrames()
+        self.__epoch = time.monotonic()
+        """origin of the server time sent with each tick"""
+        self.__hub = _TickHub()
         """Used to pass data to clients on each frame/tick"""
+        self.__outboxes: "set[_Outbox]" = set()
+        self.__recorder = None if record is None else Recorder(record)
+        self.__capture: "_ProfileCapture | None" = None
+        # Encode the static entities now, rather than on the first connection.
+        self.__gs.static_layer()
+
+    def static_layer(self) -> StaticLayer:
+        return self.__gs.static_layer()
+
+    def static_chunk_layer(self, cx: int, cy: int) -> "StaticLayer | None":
+        """One chunk's static entities, if the map is chunked (see `GameState.static_chunk_layer`)."""
+        return self.__gs.static_chunk_layer(cx, cy)
+
+    def close(self):
+        """Stop the shard worker processes and finish the recording, if any"""
+        if type(self.__gs) == ShardedGameState:
+            self.__gs.close()
+        if self.__recorder is not None:
+            self.__recorder.close()
+
+    def send_stats(self):
+        """Messages sent and dropped so far, for each connected client."""
+        return [{"sent": ob.sent, "dropped": ob.dropped} for ob in self.__outboxes]
+
+    def profile_ticks(self, nticks: int, filename = "ticks.pstats") -> "asyncio.Future[str] | None":
+        """Run cProfile over the next `nticks` ticks. The stats are dumped to `filename`,
+        and the future's result is a report of the top functions by cumulative time.
+        Returns None if a capture is already running.
+        >>> import os
+        >>> async def two_at_once():
+        ...     cm = _ConnMgr(debug=True)
+        ...     first = cm.profile_ticks(1, filename=os.devnull)
+        ...     second = cm.profile_ticks(1, filename=os.devnull)
+        ...     cm.trigger_tick()
+        ...     return second, "cumulative" in await first
+        >>> asyncio.run(two_at_once())
+        (None, True)
+        """
+        if self.__capture is not None:
+            return None
+        self.__capture = _ProfileCapture(nticks, filename)
+        return self.__capture.done
 
     def trigger_tick(self):
-        """Notify all subscribers of the latest game state computed by `.tick()`.
-        If the result of a tick is empty (no change), then don't notify subscribers."""
-        r = self.__gs.tick()
-        if r != "{}":
-            self.__tickresult.on_next(r)
-
-    def ws_setup(self, websocket_send_sync: Callable, verbose=False):
-        """Create connections between the `websocket` and rxpy, and send GameState static entities to the client.  
+        """Publish the latest game state computed by `.tick()` to all clients.
+        Each client picks a keyframe or a patch from `self.__frames`."""
+        capture = self.__capture
+        if capture is not None:
+            capture.profiler.enable()
+        spans = self.spans
+        started = spans.start()
+        snap = self.__gs.tick()
+        spans.end("tick", started)
+        started = spans.start()
+        self.__frames.push(snap, t=round((time.monotonic() - self.__epoch) * 1000))
+        if self.__recorder is not None:
+            self.__recorder.end_tick()
+        spans.end("push", started)
+        started = spans.start()
+        self.__hub.publish(self.__frames)
+        spans.end("fan_out", started)
+        if capture is not None:
+            capture.profiler.disable()
+            if capture.count_tick():
+                self.__capture = None
+
+    def ws_setup(self, websocket_send_sync: Callable, verbose=False, wire: 'Literal["json", "binary"]' = "json", outbox: "_Outbox | None" = None,
+                 viewport: "tuple[int, int] | None" = None):
+        """Connect the `websocket` to the tick `_TickHub`, and tell the client which version of the
+        static entities to fetch (they're served over HTTP, so browsers can cache them).  
+        With `wire="binary"`, player positions are sent as bytes (see `TickFrames.for_binary_client`),
+        so `websocket_send_sync` must handle both `str` and `bytes`.
+        If `outbox` is given, its writer renders the latest tick whenever it's ready to send
+        (see `_Outbox.follow`), at the rate set by `_UpdateRate`. Otherwise, each tick is
+        rendered and sent right away.
+        If `viewport` (width, height) is given, JSON clients only get what's near their player
+        (see `AreaOfInterest`). It's ignored for binary clients.
+        The first tick message after the server handles more of the client's messages carries
+        an "ack" (see `_InputAcks` and `with_ack`); if there's nothing else to send,
+        it goes in a message of its own, with "frame": "ack".
         Returns `(proc, discon)`:
-        - `proc`: should call this on incoming messages from the client
+        - `proc`: should call this on incoming messages from the client, text or bytes (see `CliEvent`)
         - `discon`: should call this when the connection is complete
         Demo in module docstring/doctest.
+
+        Malformed messages are dropped with a warning:
+        >>> proc, discon = _ConnMgr().ws_setup(lambda x: None)
+        >>> proc('{"eventkind": "keydown"}')
+        W: keydown event should have exactly these string fields: ['eventkind', 'key']
+        >>> discon()
         """
         
         def proc(payload):
@@ -133,31 +625,85 @@ class _ConnMgr:
                 ev = Disconnect(cid)
             else:
                 ev = CliEvent(cid, payload)
+                acks.received(self.__frames.seq)
+                rate.received(self.__frames.seq)
+                if outbox is not None:
+                    outbox.set_every(1)
             if verbose:
                 print("proc:", ev)
-            self.__gs.process_cli_msg(ev)
+            if self.__recorder is not None:
+                self.__recorder.record(ev)
+            try:
+                self.__gs.process_cli_msg(ev)
+            except BadPayload as e:
+                # Drop it, rather than letting one bad message end the connection.
+                print("W:", e)
 
         def discon():
-            """Tell the GameState that this client disconnected, and dispose the tick subscribe resources."""
-            disposable_tick.dispose()
+            """Tell the GameState that this client disconnected, and stop sending it ticks."""
+            unsubscribe()
             proc(None)
 
-        websocket_send_sync(self.__gs.get_static())
+        last_seq = None
+        """The last tick this client was sent. Websockets are ordered and reliable,
+        so the client has applied every frame up to here."""
+        acks = _InputAcks()
+        sent_ack = 0
+        def render(frames: TickFrames) -> "list[str | bytes]":
+            nonlocal last_seq, sent_ack
+            started = self.spans.start()
+            if wire == "binary":
+                msgs = frames.for_binary_client(last_seq)
+            elif aoi is not None:
+                msg = aoi.render(frames)
+                msgs = [] if msg is None else [msg]
+            else:
+                msg = frames.for_client(last_seq)
+                msgs = [] if msg is None else [msg]
+            last_seq = frames.seq
+            if outbox is not None and self.adaptive_rates:
+                outbox.set_every(rate.every(frames))
+            ack = acks.acked(frames.seq)
+            if ack != sent_ack:
+                sent_ack = ack
+                if msgs:
+                    msgs[0] = with_ack(msgs[0], ack)
+                else:
+                    msgs = [with_ack(json.dumps({"frame": "ack", **frames.stamp()}), ack)]
+            self.spans.end("render", started)
+            return msgs
+
+        def on_tick(frames: TickFrames):
+            for msg in render(frames):
+                websocket_send_sync(msg)
+
+        websocket_send_sync(json.dumps({"static_version": self.__gs.static_layer().version}))
         cid = "".join(random.sample(string.ascii_lowercase, k=10))
-        disposable_tick = self.__tickresult.subscribe(on_next=websocket_send_sync)
+        aoi = None if viewport is None else AreaOfInterest(cid, *viewport)
+        rate = _UpdateRate(cid)
+        if outbox is not None:
+            outbox.follow(self.__hub, render)
+            unsubscribe = lambda: None
+        else:
+            unsubscribe = self.__hub.subscribe(on_tick)
         return proc, discon
 
-    async def websocket_endpoint_impl(self, websocket_send, websocket_recv, max_rcv_msgs = int(10e9)):
+    async def websocket_endpoint_impl(self, websocket_send, websocket_recv, max_rcv_msgs = int(10e9), wire: 'Literal["json", "binary"]' = "json",
+                                      viewport: "tuple[int, int] | None" = None):
         """Setup using `ws_setup`, then repeatedly call `websocket_recv` to receive from this client until the client disconnects or `max_rcv_msgs` is reached. To receive for a long time, set `max_rcv_msgs` arbitrarily high.
         
         Ultimately close the connection if any of these occur:
         - the client disconnects (`WebSocketDisconnect` is raised)
         - `max_rcv_msgs` is reached
         - Any other exception is raised (these exceptions are intentionally not caught)
+
+        Sends go through an `_Outbox`, so a slow client skips stale ticks rather than
+        piling up pending sends.
         """
-        def send_sync(x):
-            asyncio.create_task(websocket_send(x))
-        proc, discon = self.ws_setup(send_sync)
+        outbox = _Outbox(websocket_send)
+        self.__outboxes.add(outbox)
+        writer = asyncio.create_task(outbox.run())
+        proc, discon = self.ws_setup(outbox.put, wire=wire, outbox=outbox, viewport=viewport)
         try:
             for _i in range(max_rcv_msgs):
                 proc(await websocket_recv())
@@ -165,10 +711,28 @@ class _ConnMgr:
             pass 
         finally:
             discon()
-
-
-_connmgr = _ConnMgr()
+            self.__outboxes.discard(outbox)
+            outbox.close()
+            # If the client is gone, the writer's last send fails too; that's expected.
+            await asyncio.gather(writer, return_exceptions=True)
+
+
+_shards = 0
+"""Worker processes to split the world across. 0 runs everything in this process."""
+_mapfile = "map.txt"
+"""A text map, or one written by `srv6_helper.write_chunked_map` for a world too big
+to load all at once. Clients then fetch static entities a chunk at a time."""
+_record: "str | None" = None
+"""File to record every client event to, for replaying with srv6_replay.py"""
+_connmgr = _ConnMgr(shards=_shards, mapfile=_mapfile, record=_record)
+_profile_spans = False
+"""Time each phase of each tick from the start, for `/profile`. Costs a few microseconds per tick.
+Can also be switched on and off with `POST /profile?enabled=true`."""
+_connmgr.spans.enabled = _profile_spans
+_spans_log_every = 0
+"""Seconds between log lines of tick phase timings. 0 means never."""
 _fps = 30
+_tickstats = _TickStats(_fps)
 app = FastAPI(lifespan=_lifespan)
 app.mount("/assets", StaticFiles(directory="assets"), name="assets")
 
@@ -179,10 +743,102 @@ async def gethome():
         return HTMLResponse(f.read())
 
 
+def _static_response(layer: StaticLayer, version: str, if_none_match: str, accept_encoding: str) -> Response:
+    """The response for `GET /static/{version}`. A version's content never changes,
+    so browsers may keep it for good, and only need to ask again on a new version.
+    >>> layer = StaticLayer.encode({})
+    >>> r = _static_response(layer, layer.version, "", "gzip, deflate")
+    >>> r.status_code, r.headers["content-encoding"], r.headers["etag"] == f'"{layer.version}"'
+    (200, 'gzip', True)
+    >>> _static_response(layer, layer.version, f'"{layer.version}"', "gzip").status_code
+    304
+    >>> _static_response(layer, "oldversion", "", "gzip").status_code
+    404
+    """
+    if version != layer.version:
+        return Response(status_code=404)
+    headers = {"ETag": f'"{layer.version}"', "Cache-Control": "public, max-age=31536000, immutable",
+               "Vary": "Accept-Encoding"}
+    if headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if "gzip" in accept_encoding:
+        return Response(layer.gzipped, media_type="application/json", headers={**headers, "Content-Encoding": "gzip"})
+    return Response(layer.json, media_type="application/json", headers=headers)
+
+
+@app.get("/static/{version}")
+async def getstatic(version: str, request: Request):
+    """The static entities, as `{"static": {...}}`. The websocket's first message says which version."""
+    return _static_response(_connmgr.static_layer(), version,
+                            request.headers.get("if-none-match", ""), request.headers.get("accept-encoding", ""))
+
+
+@app.get("/static/{version}/{chunk}")
+async def getstaticchunk(version: str, chunk: str, request: Request):
+    """The static entities of chunk "cx,cy" of a chunked map, as `{"static": {...}}`.
+    `version` is the map's, from the websocket's first message; `/static/{version}`
+    says how big chunks are, in "chunk_px"."""
+    if version != _connmgr.static_layer().version:
+        return Response(status_code=404)
+    try:
+        cx, cy = map(int, chunk.split(","))
+    except ValueError:
+        return Response(status_code=404)
+    layer = await asyncio.to_thread(_connmgr.static_chunk_layer, cx, cy)
+    if layer is None:
+        return Response(status_code=404)
+    return _static_response(layer, layer.version,
+                            request.headers.get("if-none-match", ""), request.headers.get("accept-encoding", ""))
+
+
+@app.get("/metrics")
+async def getmetrics():
+    return {"tick": _tickstats.todict(), "clients": _connmgr.send_stats()}
+
+
+@app.get("/profile")
+async def getprofile():
+    """Percentiles of the time spent in each phase of recent ticks (empty unless timing is enabled)"""
+    return {"enabled": _connmgr.spans.enabled, "phases": _connmgr.spans.todict()}
+
+
+@app.post("/profile")
+async def setprofile(enabled: bool):
+    _connmgr.spans.enabled = enabled
+    return {"enabled": enabled}
+
+
+@app.get("/profile/capture")
+async def captureprofile(ticks: int = 90):
+    """Run cProfile over the next `ticks` ticks and return the report.
+    The full stats are also saved to `ticks.pstats`, for `python -m pstats` or snakeviz."""
+    done = _connmgr.profile_ticks(ticks)
+    if done is None:
+        return PlainTextResponse("A capture is already running; try again when it's done.", status_code=409)
+    return PlainTextResponse(await done)
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    """Connect with `/ws?wire=binary` to get player positions as bytes,
+    or with `/ws?view=1000x800` to only get what's within a 1000x800 px view of the player.
+    Clients can send key events as bytes too, on either wire (see `BINARY_KEY_EVENTS`)."""
+    async def send(x: "str | bytes"):
+        if type(x) == bytes:
+            await websocket.send_bytes(x)
+        else:
+            await websocket.send_text(x)
+    async def recv() -> "str | bytes":
+        msg = await websocket.receive()
+        if msg["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(msg.get("code", 1000))
+        return msg["text"] if msg.get("text") is not None else msg["bytes"]
+    wire = "binary" if websocket.query_params.get("wire") == "binary" else "json"
+    view = websocket.query_params.get("view", "")
+    w, _x, h = view.partition("x")
+    viewport = (int(w), int(h)) if w.isdigit() and h.isdigit() else None
     await websocket.accept()
-    await _connmgr.websocket_endpoint_impl(websocket.send_text, websocket.receive_text)
+    await _connmgr.websocket_endpoint_impl(send, recv, wire=wire, viewport=viewport)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,342 @@
+"""
+Rough benchmarks for `srv6_helper`, and the tick fan-out in `srv6`.
+
+To run (from the folder containing `missions.toml`):
+    python archived/srv6_bench.py
+
+Maps are generated on the fly, so the numbers don't depend on `map.txt`.
+>>> make_map(4, 3, wall_every=0)
+'wwww\\nw  w\\nwwww'
+"""
+import asyncio
+import dataclasses
+import json
+import os
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from srv6_helper import GameState, CliEvent, TickFrames, Player, pack_positions, AreaOfInterest, InitEv, KeydownEv, KeyupEv, write_chunked_map
+
+
+def make_map(width: int, height: int, wall_every = 7):
+    """Text map with a solid border, and roughly one tree per `wall_every` tiles inside.
+    `wall_every = 0` means no trees."""
+    rng = random.Random(width * height)
+    lines = []
+    for y in range(height):
+        row = ""
+        for x in range(width):
+            if y in (0, height - 1) or x in (0, width - 1):
+                row += "w"
+            elif wall_every and rng.randrange(wall_every) == 0:
+                row += "t"
+            else:
+                row += " "
+        lines.append(row)
+    return "\n".join(lines)
+
+
+def gamestate_with(maptext: str, nplayers: int):
+    """A GameState on `maptext`, with `nplayers` players walking around."""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        f.write(maptext)
+    try:
+        gs = GameState(mapfile=f.name)
+    finally:
+        os.remove(f.name)
+    rng = random.Random(nplayers)
+    for i in range(nplayers):
+        cid = f"bot{i}"
+        gs.process_cli_msg(CliEvent(cid, '{"eventkind": "init", "name": "bot", "avatar": "/assets/robot_idle.png"}'))
+        key = rng.choice("wasd")
+        gs.process_cli_msg(CliEvent(cid, f'{{"eventkind": "keydown", "key": "{key}"}}'))
+    gs.apply_inputs()
+    return gs
+
+
+def time_ticks(gs: GameState, nticks = 30):
+    """Average seconds per `gs.tick()`"""
+    start = time.perf_counter()
+    for _i in range(nticks):
+        gs.tick()
+    return (time.perf_counter() - start) / nticks
+
+
+def bench_tick():
+    print(f"{'map':>9} {'entities':>9} {'players':>8} {'ms/tick':>8}")
+    for side in [50, 100, 200, 400]:
+        for nplayers in [1, 10, 50, 200]:
+            maptext = make_map(side, side)
+            gs = gamestate_with(maptext, nplayers)
+            nents = maptext.count("w") + maptext.count("t")
+            ms = time_ticks(gs) * 1000
+            print(f"{side:>4}x{side:<4} {nents:>9} {nplayers:>8} {ms:>8.3f}")
+
+
+def bench_step(nticks = 30):
+    """`GameState.step` without the snapshot: one player at a time vs. batched."""
+    print(f"{'players':>8} {'scalar ms':>10} {'batched ms':>11}")
+    for nplayers in [10, 100, 1000]:
+        timings = []
+        for batched in [False, True]:
+            gs = gamestate_with(make_map(100, 100), nplayers)
+            start = time.perf_counter()
+            for _i in range(nticks):
+                gs.step(batched)
+            timings.append((time.perf_counter() - start) / nticks * 1000)
+        print(f"{nplayers:>8} {timings[0]:>10.3f} {timings[1]:>11.3f}")
+
+
+def _get_payload_ifelif(payload_raw: str):
+    """How `CliEvent.get_payload` used to decode, for comparison"""
+    parsed = json.loads(payload_raw)
+    if parsed["eventkind"] == "init":
+        return InitEv(**parsed)
+    elif parsed["eventkind"] == "keydown":
+        return KeydownEv(**parsed)
+    elif parsed["eventkind"] == "keyup":
+        return KeyupEv(**parsed)
+    else:
+        raise NotImplementedError()
+
+
+def bench_decode(nmsgs = 100_000):
+    """Messages decoded per second, for a stream that's mostly key events."""
+    rng = random.Random(0)
+    texts, binaries = [], []
+    for i in range(nmsgs):
+        if i % 100 == 0:
+            texts.append('{"eventkind": "init", "name": "bot", "avatar": "/assets/robot_idle.png"}')
+            binaries.append(texts[-1])
+        else:
+            kind, key = rng.choice([("keydown", 1), ("keyup", 2)]), rng.choice("wasd ")
+            texts.append(json.dumps({"eventkind": kind[0], "key": key}))
+            binaries.append(bytes([kind[1], ord(key)]))
+    decoders = {
+        "if/elif": lambda: [_get_payload_ifelif(t) for t in texts],
+        "registry": lambda: [CliEvent("bot", t).get_payload() for t in texts],
+        "binary": lambda: [CliEvent("bot", b).get_payload() for b in binaries],
+    }
+    print(f"{'decoder':>10} {'msgs/sec':>10}")
+    for name, decode in decoders.items():
+        secs = timeit.timeit(decode, number=1)
+        print(f"{name:>10} {nmsgs / secs:>10.0f}")
+
+
+def bench_egress(nticks = 90):
+    """Bytes sent to one client per tick: full state every tick vs. keyframes + patches.
+    Only a few of the players are moving, as on a typical mostly-idle map."""
+    print(f"{'players':>8} {'full B/tick':>12} {'delta B/tick':>13}")
+    for nplayers in [10, 50, 200]:
+        gs = gamestate_with(make_map(100, 100), nplayers)
+        for i in range(5, nplayers):
+            gs.process_cli_msg(CliEvent(f"bot{i}", '{"eventkind": "keyup", "key": "w"}'))
+            gs.process_cli_msg(CliEvent(f"bot{i}", '{"eventkind": "keyup", "key": "a"}'))
+        frames = TickFrames()
+        full = delta = 0
+        for _i in range(nticks):
+            frames.push(gs.tick())
+            full += len(gs.jsondumps())
+            delta += len(frames.for_client(frames.seq - 1) or "")
+        print(f"{nplayers:>8} {full // nticks:>12} {delta // nticks:>13}")
+
+
+def bench_encode():
+    """Encoding one tick's players: the old `dataclasses.asdict` JSON,
+    the current JSON, and the binary positions frame."""
+    print(f"{'players':>8} {'encoding':>10} {'us/tick':>9} {'bytes':>8}")
+    for nplayers in [10, 100, 1000]:
+        players = {f"{i:010d}": Player(50 * i, 500, "bot", "/assets/robot_idle.png") for i in range(nplayers)}
+        snap = {k: p.todict() for k, p in players.items()}
+        encoders = {
+            "asdict": lambda: json.dumps({k: dataclasses.asdict(p) for k, p in players.items()}),
+            "json": lambda: json.dumps({k: p.todict() for k, p in players.items()}),
+            "binary": lambda: pack_positions(1, snap),
+        }
+        for name, encode in encoders.items():
+            n = 20
+            us = timeit.timeit(encode, number=n) / n * 1e6
+            print(f"{nplayers:>8} {name:>10} {us:>9.1f} {len(encode()):>8}")
+
+
+def bench_aoi(nticks = 30, world = 10000):
+    """Total bytes per tick to all clients, everyone moving, spread over a `world` px square map:
+    the shared patch for everyone vs. each client's `AreaOfInterest`."""
+    print(f"{'players':>8} {'shared B/tick':>14} {'aoi B/tick':>11}")
+    for nplayers in [10, 100, 1000]:
+        rng = random.Random(nplayers)
+        players = {f"bot{i}": {"x": rng.randrange(0, world, 50), "y": rng.randrange(0, world, 50), "name": "bot"} for i in range(nplayers)}
+        frames = TickFrames()
+        aois = [AreaOfInterest(cid, 1000, 1000) for cid in players]
+        shared = aoi = 0
+        for _i in range(nticks):
+            players = {k: {**p, "x": p["x"] + rng.choice([-50, 0, 50])} for k, p in players.items()}
+            frames.push({"dynamic": {}, "players": players})
+            shared += len(frames.for_client(frames.seq - 1) or "") * nplayers
+            aoi += sum(len(a.render(frames) or "") for a in aois)
+        print(f"{nplayers:>8} {shared // nticks:>14} {aoi // nticks:>11}")
+
+
+class _RxOutbox:
+    """How `srv6._Outbox` used to get ticks, through an Rx Subject, for comparison"""
+    def __init__(self, websocket_send):
+        self.__send = websocket_send
+        self.__tick = None
+        self.__wake = asyncio.Event()
+
+    def put_tick(self, render):
+        self.__tick = render
+        self.__wake.set()
+
+    async def run(self):
+        while True:
+            await self.__wake.wait()
+            self.__wake.clear()
+            if self.__tick is not None:
+                render, self.__tick = self.__tick, None
+                for msg in render():
+                    await self.__send(msg)
+
+
+def bench_fanout(nticks = 30):
+    """Per tick: time to publish to every client (`publish`), and until every client's
+    writer has sent it (`delivered`). The Rx Subject that `_ConnMgr` used to have vs. `_TickHub`."""
+    from rx.subject import Subject
+    from srv6 import _TickHub, _Outbox
+
+    async def measure(nclients: int, use_hub: bool):
+        frames = TickFrames()
+        frames.push({"dynamic": {}, "players": {}})
+        pending = 0
+        async def send(x):
+            nonlocal pending
+            pending -= 1
+        render = lambda frames: [frames.for_client(frames.seq - 1)]
+        if use_hub:
+            hub = _TickHub()
+            outboxes = [_Outbox(send) for _ in range(nclients)]
+            for ob in outboxes:
+                ob.follow(hub, render)
+            publish = lambda: hub.publish(frames)
+        else:
+            subject = Subject()
+            outboxes = [_RxOutbox(send) for _ in range(nclients)]
+            for ob in outboxes:
+                subject.subscribe(on_next=lambda frames, ob=ob: ob.put_tick(lambda: render(frames)))
+            publish = lambda: subject.on_next(frames)
+        writers = [asyncio.create_task(ob.run()) for ob in outboxes]
+        await asyncio.sleep(0)
+        publish_secs = delivered_secs = 0.0
+        for _i in range(nticks):
+            pending = nclients
+            start = time.perf_counter()
+            publish()
+            publish_secs += time.perf_counter() - start
+            while pending > 0:
+                await asyncio.sleep(0)
+            delivered_secs += time.perf_counter() - start
+        for w in writers:
+            w.cancel()
+        await asyncio.gather(*writers, return_exceptions=True)
+        return publish_secs / nticks * 1000, delivered_secs / nticks * 1000
+
+    print(f"{'clients':>8} {'fan-out':>8} {'publish ms':>11} {'delivered ms':>13}")
+    for nclients in [10, 100, 1000]:
+        for name, use_hub in [("rx", False), ("hub", True)]:
+            publish_ms, delivered_ms = asyncio.run(measure(nclients, use_hub))
+            print(f"{nclients:>8} {name:>8} {publish_ms:>11.3f} {delivered_ms:>13.3f}")
+
+
+def bench_update_rates(nticks = 90):
+    """Bytes per tick for all clients, with 1 in 10 clients walking around and the rest idle,
+    spread over an open map: every client at the full rate vs. `_UpdateRate`.
+    Send time isn't reported: here every client gets the whole-world patch, and the
+    per-tick time was within run-to-run noise either way."""
+    from srv6 import _ConnMgr
+
+    async def measure(nclients: int, adaptive: bool):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+            f.write(make_map(400, 400, wall_every=0))
+        spawns = [(x, y) for y in range(500, 19500, 800) for x in range(500, 19500, 800)]
+        try:
+            cm = _ConnMgr(mapfile=f.name, spawns=spawns, adaptive_rates=adaptive)
+        finally:
+            os.remove(f.name)
+        sent = 0
+        async def send(x):
+            nonlocal sent
+            sent += len(x)
+        clients = []
+        for i in range(nclients):
+            events = ['{"eventkind": "init", "name": "bot", "avatar": "/assets/robot_idle.png"}']
+            if i % 10 == 0:
+                events.append('{"eventkind": "keydown", "key": "d"}')
+            async def recv(events=events):
+                if events:
+                    return events.pop(0)
+                await asyncio.Event().wait()
+            clients.append(asyncio.create_task(cm.websocket_endpoint_impl(send, recv)))
+        for _i in range(5):
+            cm.trigger_tick()
+            await asyncio.sleep(0)
+        sent = 0
+        for _i in range(nticks):
+            cm.trigger_tick()
+            for _j in range(3):
+                await asyncio.sleep(0)
+        for c in clients:
+            c.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        return sent / nticks
+
+    print(f"{'clients':>8} {'rates':>9} {'B/tick':>9}")
+    for nclients in [100, 500]:
+        for name, adaptive in [("fixed", False), ("adaptive", True)]:
+            nbytes = asyncio.run(measure(nclients, adaptive))
+            print(f"{nclients:>8} {name:>9} {nbytes:>9.0f}")
+
+
+def bench_map_loading():
+    """Time and memory to start a GameState and run its first few ticks with 10 players,
+    as the world grows: a text map (everything loaded up front) vs. the same map chunked
+    (only chunks near players loaded). Writing the chunked file isn't counted."""
+    def measure(mapfile: str):
+        tracemalloc.start()
+        start = time.perf_counter()
+        gs = GameState(mapfile=mapfile)
+        for i in range(10):
+            gs.process_cli_msg(CliEvent(f"bot{i}", '{"eventkind": "init", "name": "bot", "avatar": "/assets/robot_idle.png"}'))
+        for _i in range(3):
+            gs.tick()
+        secs = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return secs * 1000, peak / 1e6
+
+    print(f"{'tiles':>11} {'map':>8} {'startup ms':>11} {'peak MB':>8}")
+    for side in [100, 400, 1000]:
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+            f.write(make_map(side, side))
+        try:
+            write_chunked_map(f.name, f.name + ".chunks")
+            for name, mapfile in [("text", f.name), ("chunked", f.name + ".chunks")]:
+                ms, mb = measure(mapfile)
+                print(f"{side:>5}x{side:<5} {name:>8} {ms:>11.1f} {mb:>8.1f}")
+        finally:
+            os.remove(f.name)
+            os.remove(f.name + ".chunks")
+
+
+if __name__ == "__main__":
+    bench_tick()
+    bench_step()
+    bench_decode()
+    bench_egress()
+    bench_encode()
+    bench_aoi()
+    bench_fanout()
+    bench_update_rates()
+    bench_map_loading()
@@ -5,9 +5,10 @@ Initially no players:
 >>> gs.current()
 {'dynamic': {}, 'players': {}}
 
-A client joins:
+A client joins. Events are queued until the next tick, or `apply_inputs`:
 >>> ce = CliEvent('fakeid', '{"eventkind": "init", "name": "abc", "avatar": "/assets/somefile.png"}')
 >>> gs.process_cli_msg(ce)
+>>> gs.apply_inputs()
 >>> gs.current()
 {'dynamic': {}, 'players': {'fakeid': Player(x=500, y=500, name='abc', avatar='/assets/somefile.png', change_x=0, change_y=0)}}
 
@@ -15,13 +16,23 @@ A client joins:
 >>> gs.current()
 {'dynamic': {}, 'players': {'fakeid': Player(x=500, y=500, name='abc', avatar='/assets/somefile.png', change_x=0, change_y=-50)}}
 """
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor
 import copy
 from dataclasses import dataclass
 import dataclasses
+import functools
+import gzip
+import hashlib
 import json
+import os
 import random
+import struct
+import time
 from typing import Literal, Callable, Union
 
+import numpy as np
 import toml
 
 
@@ -71,7 +82,233 @@ class Player:
     assigned_mission: "Mission | None" = None
 
     def todict(self):
-        return dataclasses.asdict(self)
+        """Like `dataclasses.asdict`, but the nested entity and missions are only
+        converted when they're set, instead of being deep-copied every tick.
+        >>> Player(0, 50, "abc").todict()
+        {'x': 0, 'y': 50, 'name': 'abc', 'avatar': '/assets/femaleAdventurer_idle.png', 'change_x': 0, 'change_y': 0, 'facing_direction': 'd', 'trying_action': False, 'talking_to': None, 'completed_missions': [], 'potential_mission': None, 'assigned_mission': None}
+        """
+        return {
+            "x": self.x,
+            "y": self.y,
+            "name": self.name,
+            "avatar": self.avatar,
+            "change_x": self.change_x,
+            "change_y": self.change_y,
+            "facing_direction": self.facing_direction,
+            "trying_action": self.trying_action,
+            "talking_to": self.talking_to and self.talking_to.todict(),
+            "completed_missions": [dataclasses.asdict(m) for m in self.completed_missions],
+            "potential_mission": self.potential_mission and dataclasses.asdict(self.potential_mission),
+            "assigned_mission": self.assigned_mission and dataclasses.asdict(self.assigned_mission),
+        }
+
+
+_FACINGS = "wasd"
+
+
+def _numeric_attr(column: str):
+    def get(self: "PlayerView"):
+        return getattr(self._table, column)[self._table.rows[self.cid]].item()
+    def set(self: "PlayerView", val):
+        getattr(self._table, column)[self._table.rows[self.cid]] = val
+    return property(get, set)
+
+
+def _object_attr(column: str):
+    def get(self: "PlayerView"):
+        return getattr(self._table, column)[self._table.rows[self.cid]]
+    def set(self: "PlayerView", val):
+        getattr(self._table, column)[self._table.rows[self.cid]] = val
+    return property(get, set)
+
+
+class PlayerView:
+    """One player in a `PlayerTable`. Has the same attributes as `Player`, but reads
+    and writes go straight to the table's columns, so code written for a `Player`
+    (like `handle_ce_impl`) works on either."""
+    __slots__ = ("_table", "cid")
+
+    def __init__(self, table: "PlayerTable", cid: str):
+        self._table = table
+        self.cid = cid
+
+    x = _numeric_attr("x")
+    y = _numeric_attr("y")
+    change_x = _numeric_attr("change_x")
+    change_y = _numeric_attr("change_y")
+    trying_action = _numeric_attr("trying_action")
+    name = _object_attr("name")
+    avatar = _object_attr("avatar")
+    talking_to = _object_attr("talking_to")
+    completed_missions = _object_attr("completed_missions")
+    potential_mission = _object_attr("potential_mission")
+    assigned_mission = _object_attr("assigned_mission")
+
+    @property
+    def facing_direction(self):
+        return _FACINGS[self._table.facing[self._table.rows[self.cid]]]
+
+    @facing_direction.setter
+    def facing_direction(self, val: str):
+        self._table.facing[self._table.rows[self.cid]] = _FACINGS.index(val)
+
+    def toplayer(self) -> Player:
+        """A standalone copy, e.g. to hand over to another process"""
+        return Player(self.x, self.y, self.name, self.avatar, self.change_x, self.change_y,
+                      self.facing_direction, self.trying_action, self.talking_to,  # type: ignore
+                      list(self.completed_missions), self.potential_mission, self.assigned_mission)
+
+    def todict(self):
+        return self.toplayer().todict()
+
+    def __repr__(self):
+        return repr(self.toplayer())
+
+
+class PlayerTable(MutableMapping):
+    """Players stored by column rather than as one object each: NumPy arrays for the
+    numbers that change every tick, plain lists for everything else, and `rows`
+    mapping client id -> row. Behaves like a `dict[str, Player]`, except the values
+    are `PlayerView`s.
+    >>> t = PlayerTable()
+    >>> t["abc"] = Player(0, 50, "abc")
+    >>> t["def"] = Player(100, 50, "def", change_x=50)
+    >>> t["abc"].change_y = -50
+    >>> t.move()
+    >>> t["abc"].y, t["def"].x
+    (0, 150)
+    >>> t.x[:len(t)]
+    array([  0, 150])
+
+    Popping a player gives back a standalone `Player`. The last row is moved into the gap:
+    >>> t.pop("abc").change_y
+    -50
+    >>> list(t), t.rows
+    (['def'], {'def': 0})
+    >>> t.todicts()["def"] == t["def"].todict()
+    True
+    """
+    NUMERIC = {"x": np.int64, "y": np.int64, "change_x": np.int64, "change_y": np.int64,
+               "facing": np.uint8, "trying_action": np.bool_}
+    OBJECTS = ("name", "avatar", "talking_to", "completed_missions", "potential_mission", "assigned_mission")
+
+    def __init__(self, capacity = 64):
+        self.rows: "dict[str, int]" = {}
+        self.cids: "list[str]" = []
+        """client id of each row"""
+        for column, dtype in self.NUMERIC.items():
+            setattr(self, column, np.zeros(capacity, dtype))
+        for column in self.OBJECTS:
+            setattr(self, column, [])
+        self.x: np.ndarray
+        self.y: np.ndarray
+        self.change_x: np.ndarray
+        self.change_y: np.ndarray
+        self.facing: np.ndarray
+        self.trying_action: np.ndarray
+
+    def __len__(self):
+        return len(self.cids)
+
+    def __iter__(self):
+        return iter(list(self.cids))
+
+    def __contains__(self, cid):
+        return cid in self.rows
+
+    def __getitem__(self, cid: str) -> PlayerView:
+        if cid not in self.rows:
+            raise KeyError(cid)
+        return PlayerView(self, cid)
+
+    def __setitem__(self, cid: str, p: "Player | PlayerView"):
+        if cid not in self.rows:
+            if len(self.cids) == len(self.x):
+                self.__grow()
+            self.rows[cid] = len(self.cids)
+            self.cids.append(cid)
+            for column in self.OBJECTS:
+                getattr(self, column).append(None)
+        row = self.rows[cid]
+        self.x[row], self.y[row] = p.x, p.y
+        self.change_x[row], self.change_y[row] = p.change_x, p.change_y
+        self.facing[row] = _FACINGS.index(p.facing_direction)
+        self.trying_action[row] = p.trying_action
+        for column in self.OBJECTS:
+            getattr(self, column)[row] = getattr(p, column)
+
+    def __delitem__(self, cid: str):
+        row = self.rows.pop(cid)
+        last = len(self.cids) - 1
+        if row != last:
+            for column in self.NUMERIC:
+                arr = getattr(self, column)
+                arr[row] = arr[last]
+            for column in self.OBJECTS:
+                col = getattr(self, column)
+                col[row] = col[last]
+            self.cids[row] = self.cids[last]
+            self.rows[self.cids[row]] = row
+        self.cids.pop()
+        for column in self.OBJECTS:
+            getattr(self, column).pop()
+
+    def pop(self, cid: str) -> Player:  # type: ignore[override]
+        p = self[cid].toplayer()
+        del self[cid]
+        return p
+
+    def __grow(self):
+        for column in self.NUMERIC:
+            old = getattr(self, column)
+            new = np.zeros(max(16, 2 * len(old)), old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+
+    def move(self):
+        """Add every player's velocity to its position."""
+        n = len(self.cids)
+        self.x[:n] += self.change_x[:n]
+        self.y[:n] += self.change_y[:n]
+
+    def copy(self) -> "PlayerTable":
+        """Copy of the whole table: the arrays are copied in one go, not player by player."""
+        t = PlayerTable(0)
+        t.rows, t.cids = dict(self.rows), list(self.cids)
+        for column in self.NUMERIC:
+            setattr(t, column, getattr(self, column)[:len(self.cids)].copy())
+        for column in self.OBJECTS:
+            setattr(t, column, list(getattr(self, column)))
+        t.completed_missions = [list(ms) for ms in self.completed_missions]
+        return t
+
+    def todicts(self) -> "dict[str, dict]":
+        """Same as `{cid: p.todict() for cid, p in self.items()}`, a column at a time."""
+        n = len(self.cids)
+        cols = zip(self.cids, self.x[:n].tolist(), self.y[:n].tolist(), self.name, self.avatar,
+                   self.change_x[:n].tolist(), self.change_y[:n].tolist(), self.facing[:n].tolist(),
+                   self.trying_action[:n].tolist(), self.talking_to, self.completed_missions,
+                   self.potential_mission, self.assigned_mission)
+        return {
+            cid: {
+                "x": x,
+                "y": y,
+                "name": name,
+                "avatar": avatar,
+                "change_x": cx,
+                "change_y": cy,
+                "facing_direction": _FACINGS[facing],
+                "trying_action": action,
+                "talking_to": talking_to and talking_to.todict(),
+                "completed_missions": [dataclasses.asdict(m) for m in completed] if completed else [],
+                "potential_mission": potential and dataclasses.asdict(potential),
+                "assigned_mission": assigned and dataclasses.asdict(assigned),
+            }
+            for cid, x, y, name, avatar, cx, cy, facing, action, talking_to, completed, potential, assigned in cols
+        }
+
+    def __repr__(self):
+        return repr(dict(self.items()))
 
 
 @dataclass
@@ -98,30 +335,106 @@ class Entity:
         return dict(impl())
            
         
+class BadPayload(ValueError):
+    """A client sent something that isn't a valid event. The event should be dropped,
+    not allowed to break the client's connection."""
+
+
+def _string_fields(cls):
+    """Check that a parsed payload has exactly the fields of `cls`, all strings."""
+    names = frozenset(f.name for f in dataclasses.fields(cls))
+    def check(parsed: dict) -> dict:
+        if parsed.keys() != names or not all(type(v) == str for v in parsed.values()):
+            raise BadPayload(f"{parsed.get('eventkind')} event should have exactly these string fields: {sorted(names)}")
+        return parsed
+    return check
+
+
+_check_init = _string_fields(InitEv)
+_check_keydown = _string_fields(KeydownEv)
+_check_keyup = _string_fields(KeyupEv)
+_check_click = _string_fields(ClickEv)
+
+
+@functools.lru_cache(maxsize=256)
+def _keydown(key: str):
+    return KeydownEv(key, "keydown")
+
+
+@functools.lru_cache(maxsize=256)
+def _keyup(key: str):
+    return KeyupEv(key, "keyup")
+
+
+PAYLOAD_DECODERS: "dict[str, Callable[[dict], Payload]]" = {
+    "init": lambda d: InitEv(**_check_init(d)),
+    "keydown": lambda d: _keydown(_check_keydown(d)["key"]),
+    "keyup": lambda d: _keyup(_check_keyup(d)["key"]),
+    "click": lambda d: ClickEv(**_check_click(d)),
+}
+"""eventkind -> function that turns the parsed JSON into a Payload, or raises BadPayload.
+Key events are the bulk of traffic, so the same few KeydownEv/KeyupEv objects are
+handed out again rather than making new ones. Don't mutate payloads."""
+
+BINARY_KEY_EVENTS: "dict[int, Callable[[str], Payload]]" = {1: _keydown, 2: _keyup}
+"""Key events can also be sent as 2 bytes: the first byte picks from this dict,
+and the second is the key as an ASCII character."""
+
+_decoded: "dict[str | bytes, Payload]" = {}
+"""Raw key event -> its payload. Clients send the exact same few messages
+over and over, so these skip `json.loads` entirely."""
+
+
 @dataclass
 class CliEvent:
     """Client Event"""
     cid: str
     """Client ID"""
-    payload_raw: str
-    """A string which we can parse using get_payload"""
+    payload_raw: "str | bytes"
+    """A string (JSON) or bytes (see `BINARY_KEY_EVENTS`), which we can parse using get_payload"""
 
     def get_payload(self) -> Payload:
-        """Parse the payload to the appropriate event type. Examples in module docstring/doctests"""
-        try:
-            parsed = json.loads(self.payload_raw)
-            if parsed["eventkind"] == "init":
-                return InitEv(**parsed)
-            elif parsed["eventkind"] == "keydown":
-                return KeydownEv(**parsed)
-            elif parsed["eventkind"] == "keyup":
-                return KeyupEv(**parsed)
-            elif parsed["eventkind"] == "click":
-                return ClickEv(**parsed)
-            else:
-                raise NotImplementedError()
-        except json.JSONDecodeError:
-            raise ValueError(f"Client {self.cid} sent invalid JSON: '{self.payload_raw}'")
+        """Parse the payload to the appropriate event type, using `PAYLOAD_DECODERS`.
+        Raises `BadPayload` if it's not a valid event. More examples in module docstring/doctests.
+        >>> CliEvent("abc", b"\\x01w").get_payload()
+        KeydownEv(key='w', eventkind='keydown')
+        >>> try:
+        ...     CliEvent("abc", '{"eventkind": "keyup", "key": 5}').get_payload()
+        ... except BadPayload as e:
+        ...     print(e)
+        keyup event should have exactly these string fields: ['eventkind', 'key']
+
+        Whatever the client sends, anything that goes wrong is a BadPayload:
+        >>> for raw in ['{"eventkind": []}', '{"eventkind": {}}', '[' * 100000, '"init"']:
+        ...     try:
+        ...         CliEvent("abc", raw).get_payload()
+        ...     except BadPayload as e:
+        ...         print(str(e).split(":")[0])
+        Client abc sent an unknown event
+        Client abc sent an unknown event
+        Client abc sent invalid JSON
+        Client abc sent an unknown event
+        """
+        raw = self.payload_raw
+        paylo = _decoded.get(raw)
+        if paylo is not None:
+            return paylo
+        if type(raw) == bytes:
+            if len(raw) != 2 or raw[0] not in BINARY_KEY_EVENTS or raw[1] > 127:
+                raise BadPayload(f"Client {self.cid} sent invalid binary event: {raw!r}")
+            paylo = BINARY_KEY_EVENTS[raw[0]](chr(raw[1]))
+        else:
+            try:
+                parsed = json.loads(raw)
+            except (ValueError, RecursionError):
+                raise BadPayload(f"Client {self.cid} sent invalid JSON: '{raw}'")
+            if not isinstance(parsed, dict) or not isinstance(parsed.get("eventkind"), str) \
+                    or parsed["eventkind"] not in PAYLOAD_DECODERS:
+                raise BadPayload(f"Client {self.cid} sent an unknown event: '{raw}'")
+            paylo = PAYLOAD_DECODERS[parsed["eventkind"]](parsed)
+        if type(paylo) in (KeydownEv, KeyupEv) and len(_decoded) < 1024:
+            _decoded[raw] = paylo
+        return paylo
 
 @dataclass
 class Disconnect:
@@ -156,18 +469,99 @@ def adjacent(p: Player, e: Entity):
     return False
 
 
-def next_available_mission(mission_status: "list[Mission]", available_missions: "list[int]"):
-    with open("missions.toml") as f:
-        missionstoml = toml.load(f)
-    missions_section = missionstoml["missions"]
-    assert type(missions_section) == list
-    missions = list(map(lambda item: Mission(**item), missions_section))
-    return Mission(23, "Investigate the Ruins", "<h2>Mission Briefing: Investigate the ruins</h2><br>Commander, we’ve detected unusual energy signatures in the nearby ruins. Your objective is to investigate the site, collect three energy crystals, and return safely.<br>Beware — hostile entities may be present.<br><br><h3>Mission Objectives</h3><br>1. Investigate site<br>2. Collect energy crystals.<br>3. Return to NPC", [])
+class MissionCatalogue:
+    """The missions file, parsed once and indexed by mission id.
+    If the file's modification time changes, `refresh()` re-reads it,
+    so edits show up without restarting the server.
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "missions.toml")
+    >>> _ = open(path, "w").write('[[missions]]\\nid = 1\\nname = "A"\\ndialog = ""\\nobjectives = []\\n')
+    >>> mc = MissionCatalogue(path)
+    >>> mc.get(1)
+    Mission(id=1, name='A', dialog='', objectives=[])
+    >>> mc.get(2) is None
+    True
 
+    After an edit:
+    >>> _ = open(path, "w").write('[[missions]]\\nid = 1\\nname = "B"\\ndialog = ""\\nobjectives = []\\n')
+    >>> os.utime(path, ns=(0, 1))
+    >>> mc.refresh()
+    >>> mc.get(1).name
+    'B'
 
-def on_action(p: Player, e: Entity):
+    A broken edit (say, a half-written save) is reported, and the missions from before
+    it are kept until the file reads properly again:
+    >>> _ = open(path, "w").write('[[missions]]\\nid = 1\\nname = "C')
+    >>> os.utime(path, ns=(0, 2))
+    >>> mc.refresh()
+    W: keeping the missions from before ...
+    >>> mc.get(1).name
+    'B'
+    >>> _ = open(path, "w").write('[[missions]]\\nid = 1\\nname = "C"\\ndialog = ""\\nobjectives = []\\n')
+    >>> os.utime(path, ns=(0, 3))
+    >>> mc.refresh()
+    >>> mc.get(1).name
+    'C'
+    """
+    def __init__(self, filename: "str | None" = None):
+        """`filename = None` gives an empty catalogue, which can be useful for doctests."""
+        self.filename = filename
+        self.__mtime: "int | None" = None
+        self.__byid: "dict[int, Mission]" = {}
+        self.refresh()
+
+    def refresh(self):
+        """Re-read the file if it changed since it was last read. This runs during ticks,
+        so once the file has been read, errors re-reading it are printed rather than raised."""
+        if self.filename is None:
+            return
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            if self.__mtime is None:
+                raise
+            return  # e.g. an editor saving by replacing the file; try again next tick
+        if mtime == self.__mtime:
+            return
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                missionstoml = toml.load(f)
+            missions_section = missionstoml["missions"]
+            assert type(missions_section) == list
+            byid = {item["id"]: Mission(**item) for item in missions_section}
+        except (OSError, toml.TomlDecodeError, KeyError, TypeError, AssertionError) as e:
+            if self.__mtime is None:
+                raise
+            print("W: keeping the missions from before", self.filename, "failed to load:", repr(e))
+            self.__mtime = mtime  # so this isn't retried (and reported) every tick, only after the next save
+            return
+        self.__byid = byid
+        self.__mtime = mtime
+
+    def get(self, mission_id: int) -> "Mission | None":
+        return self.__byid.get(mission_id)
+
+
+def next_available_mission(missions: MissionCatalogue, completed_missions: "list[Mission]", available_missions: "list[int]"):
+    """The first of `available_missions` that exists and hasn't been completed, or None.
+    >>> mc = MissionCatalogue()
+    >>> next_available_mission(mc, [], [23]) is None
+    True
+    """
+    missions.refresh()
+    completed_ids = {m.id for m in completed_missions}
+    for mission_id in available_missions:
+        if mission_id in completed_ids:
+            continue
+        m = missions.get(mission_id)
+        if m is not None:
+            return m
+    return None
+
+
+def on_action(p: Player, e: Entity, missions: MissionCatalogue):
     """If the player is trying to act and is adjacent to an interactable Entity,
-    call the entity's on_action_ function."""
+    start talking to it and offer its next available mission."""
     if not p.trying_action:
         return
     if not adjacent(p, e):
@@ -175,7 +569,7 @@ def on_action(p: Player, e: Entity):
     if not e.available_missions:
         return
     p.talking_to = e
-    p.potential_mission = next_available_mission(p.completed_missions, e.available_missions)
+    p.potential_mission = next_available_mission(missions, p.completed_missions, e.available_missions)
 
 
 def handle_collisions(p: Player, e: Entity):
@@ -185,6 +579,13 @@ def handle_collisions(p: Player, e: Entity):
             p.y -= p.change_y
 
 
+def handle_static_collisions(p: Player, blocked: "Occupancy"):
+    """Same as `handle_collisions`, but against every static entity at once."""
+    if not blocked.passable(p.x, p.y):
+        p.x -= p.change_x
+        p.y -= p.change_y
+
+
 def handle_ce_impl(paylo: Payload, player: Player):
     """Mutate `player` based on `paylo` to set the player's speed and `trying_action` attribute."""
     if type(paylo) == ClickEv:
@@ -210,6 +611,21 @@ def handle_ce_impl(paylo: Payload, player: Player):
             player.change_x = 0
 
 
+def key_effects(paylo: Payload) -> "set[str] | None":
+    """What `handle_ce_impl` overwrites for a key event: some of "x" and "y" (speed),
+    "facing" and "action" (`trying_action`). None for anything else.
+    A key event whose effects are all overwritten by later ones changes nothing.
+    >>> sorted(key_effects(KeydownEv("w", "keydown"))), key_effects(KeyupEv("d", "keyup"))
+    (['action', 'facing', 'y'], {'x'})
+    """
+    if type(paylo) == KeydownEv:
+        axis = {"w": {"y"}, "s": {"y"}, "a": {"x"}, "d": {"x"}}.get(paylo.key)
+        return {"action"} | ({"facing"} | axis if axis else set())
+    if type(paylo) == KeyupEv:
+        return {"w": {"y"}, "s": {"y"}, "a": {"x"}, "d": {"x"}}.get(paylo.key, set())
+    return None
+
+
 
 def gridify(val, gridsize):
     """
@@ -223,7 +639,162 @@ def gridify(val, gridsize):
     return round(val/gridsize) * gridsize
 
 
+class SpatialGrid:
+    """Buckets entities by the grid cell they sit in, so that a player only
+    needs to look at the few cells around it instead of every entity.
+    >>> sg = SpatialGrid()
+    >>> sg.add("wall0,0", Entity(0, 0, "", "/assets/brick2.png", False))
+    >>> sg.add("coin1,0", Entity(50, 0, "", "/assets/coin.png", True))
+    >>> [e.avatar for e in sg.at(50, 0)]
+    ['/assets/coin.png']
+    >>> [e.avatar for e in sg.near(0, 0)]
+    ['/assets/brick2.png', '/assets/coin.png']
+
+    Dynamic entities are updated incrementally:
+    >>> coin = sg.remove("coin1,0")
+    >>> coin.x = 500
+    >>> sg.add("coin1,0", coin)
+    >>> [e.avatar for e in sg.near(0, 0)]
+    ['/assets/brick2.png']
+    >>> [e.avatar for e in sg.at(500, 0)]
+    ['/assets/coin.png']
+    """
+    def __init__(self, cellsize = 50):
+        self.cellsize = cellsize
+        self.__cells: "dict[tuple[int, int], dict[str, Entity]]" = {}
+        self.__where: "dict[str, tuple[int, int]]" = {}
+        self.__codes: "np.ndarray | None" = None
+        """one int per non-empty cell, for `occupied_many`. Rebuilt after `add`/`remove`."""
+
+    def cell_of(self, x: int, y: int):
+        return x // self.cellsize, y // self.cellsize
+
+    def add(self, key: str, e: Entity):
+        """Insert `e` (or re-insert it after it moved)."""
+        if key in self.__where:
+            self.remove(key)
+        cell = self.cell_of(e.x, e.y)
+        self.__cells.setdefault(cell, {})[key] = e
+        self.__where[key] = cell
+        self.__codes = None
+
+    def remove(self, key: str) -> Entity:
+        cell = self.__where.pop(key)
+        bucket = self.__cells[cell]
+        e = bucket.pop(key)
+        if not bucket:
+            del self.__cells[cell]
+        self.__codes = None
+        return e
+
+    def at(self, x: int, y: int) -> "list[Entity]":
+        """Entities in the cell containing (x, y)."""
+        return list(self.__cells.get(self.cell_of(x, y), {}).values())
+
+    def occupied_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """For arrays of positions: whether each one's cell has any entities in it.
+        >>> SpatialGrid().occupied_many(np.array([0, 50]), np.array([0, 0]))
+        array([False, False])
+        """
+        if not self.__cells:
+            return np.zeros(len(xs), bool)
+        if self.__codes is None:
+            self.__codes = np.array(sorted(cx * 2**32 + cy for cx, cy in self.__cells), np.int64)
+        codes = (xs // self.cellsize) * 2**32 + ys // self.cellsize
+        i = np.searchsorted(self.__codes, codes).clip(0, len(self.__codes) - 1)
+        return self.__codes[i] == codes
+
+    def near(self, x: int, y: int, radius = 1) -> "list[Entity]":
+        """Entities within `radius` cells of (x, y), including its own cell."""
+        cx, cy = self.cell_of(x, y)
+        found = []
+        for gy in range(cy - radius, cy + radius + 1):
+            for gx in range(cx - radius, cx + radius + 1):
+                bucket = self.__cells.get((gx, gy))
+                if bucket:
+                    found.extend(bucket.values())
+        return found
+
+
+class Occupancy:
+    """One bit per map tile, set if a static entity blocks that tile.
+    Static entities never move, so this is built once by `loadmap`, and answers
+    "can a player stand here?" without looking at any entities.
+    >>> occ = Occupancy(-10, -10, 30, 20)
+    >>> occ.block(0, 50)
+    >>> occ.passable(0, 50), occ.passable(50, 50)
+    (False, True)
+
+    Off the map is passable, same as a tile with nothing on it:
+    >>> occ.passable(5000, 0)
+    True
+    >>> len(occ.bits)
+    75
+
+    Many positions at once, e.g. every player's:
+    >>> occ.passable_many(np.array([0, 50, 5000]), np.array([50, 50, 0]))
+    array([False,  True,  True])
+    """
+    def __init__(self, col0: int, row0: int, width: int, height: int, tile = 50):
+        """Covers `width` x `height` tiles, with the top-left tile at (col0 * tile, row0 * tile)."""
+        self.col0, self.row0 = col0, row0
+        self.width, self.height = width, height
+        self.tile = tile
+        self.bits = bytearray((width * height + 7) // 8)
+        self.__unpacked: "np.ndarray | None" = None
+        """`bits` as a 2D bool array, for `passable_many`. Rebuilt after `block`."""
+
+    def index(self, x: int, y: int) -> "int | None":
+        """Bit number of the tile containing (x, y), or None if that's off the map."""
+        col = x // self.tile - self.col0
+        row = y // self.tile - self.row0
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return row * self.width + col
+        return None
+
+    def block(self, x: int, y: int):
+        i = self.index(x, y)
+        if i is None:
+            raise IndexError(f"({x}, {y}) is off the map")
+        self.bits[i >> 3] |= 1 << (i & 7)
+        self.__unpacked = None
+
+    def passable(self, x: int, y: int) -> bool:
+        i = self.index(x, y)
+        return i is None or not self.bits[i >> 3] >> (i & 7) & 1
+
+    def passable_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """`passable` for arrays of positions, returning a bool array."""
+        if self.__unpacked is None:
+            flat = np.unpackbits(np.frombuffer(bytes(self.bits), np.uint8), bitorder="little")
+            self.__unpacked = flat[:self.width * self.height].astype(bool).reshape(self.height, self.width)
+        cols = xs // self.tile - self.col0
+        rows = ys // self.tile - self.row0
+        inside = (cols >= 0) & (cols < self.width) & (rows >= 0) & (rows < self.height)
+        result = np.ones(len(xs), bool)
+        result[inside] = ~self.__unpacked[rows[inside], cols[inside]]
+        return result
+
+
 def loadmap(currentmap):
+    """Returns `(static, dynamic, blocked)`: dicts of entities, and the `Occupancy`
+    of the static ones. The first character of the file is at (-500, -500).
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+    ...     _ = f.write("wwww\\nw c \\ntwww")
+    >>> static, dynamic, blocked = loadmap(f.name)
+    >>> os.remove(f.name)
+    >>> len(static), list(dynamic), len(blocked.bits)
+    (9, ['coin-8,-9'], 2)
+    >>> blocked.passable(-500, -450), blocked.passable(-450, -450), blocked.passable(-400, -450)
+    (False, True, True)
+    """
+    if is_chunked_map(currentmap):
+        chunked = ChunkedMap(currentmap)
+        dynamic = {}
+        for char, xidx, yidx in chunked.dynamic:
+            map_entity(char, xidx, yidx, {}, dynamic)
+        return {}, dynamic, MapChunks(chunked)
     f = open(currentmap, encoding="utf-8")
     lines = f.read().splitlines()
     f.close()
@@ -231,49 +802,882 @@ def loadmap(currentmap):
     dynamic = {}
     xindexes = range(-10, len(lines[0]))
     yindexes = range(-10, len(lines))
+    blocked = Occupancy(-10, -10, max(map(len, lines), default=0), len(lines))
     for yidx, line in zip(yindexes, lines):
         for xidx, char in zip(xindexes, line):
-            if char == "w":
-                static[f"wall{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/brick2.png", False)
-            if char == "r":
-                static[f"ruin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/ruins.png", False)
-            elif char == "t":
-                static[f"tree{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/tree.png", False, info="You hear the leaves faintly rustling as wind passes.")
-            elif char == "c":
-                dynamic[f"coin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/coin.png", True)
-            elif char == "👮":
-                dynamic[f"npc{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/alienBlue_front.png", False, available_missions=[23])
-    return static, dynamic
+            if map_entity(char, xidx, yidx, static, dynamic):
+                blocked.block(50*xidx, 50*yidx)
+    return static, dynamic, blocked
+
+
+STATIC_CHARS = "wrt"
+"""map characters for static entities; they all block their tile"""
+
+
+def map_entity(char: str, xidx: int, yidx: int, static: "dict[str, Entity]", dynamic: "dict[str, Entity]") -> bool:
+    """Add the entity for map character `char` at tile (xidx, yidx), if there is one,
+    to `static` or `dynamic`. Returns whether it's static (so blocks the tile)."""
+    if char == "w":
+        static[f"wall{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/brick2.png", False)
+    if char == "r":
+        static[f"ruin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/ruins.png", False)
+    elif char == "t":
+        static[f"tree{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/tree.png", False, info="You hear the leaves faintly rustling as wind passes.")
+    elif char == "c":
+        dynamic[f"coin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/coin.png", True)
+    elif char == "👮":
+        dynamic[f"npc{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/alienBlue_front.png", False, available_missions=[23])
+    return char in STATIC_CHARS
+
+
+_CHUNKED_MAGIC = b"CHUNKMAP "
+
+
+def is_chunked_map(filename: str) -> bool:
+    """Whether `filename` was written by `write_chunked_map`, rather than being a text map."""
+    with open(filename, "rb") as f:
+        return f.read(len(_CHUNKED_MAGIC)) == _CHUNKED_MAGIC
+
+
+def write_chunked_map(textmap: str, filename: str, chunk = 32):
+    """Convert a text map (as read by `loadmap`) into square chunks of `chunk` x `chunk` tiles,
+    so a server only needs to read the parts of a large world that players are in.
+    The file is `CHUNKMAP <header length>\\n`, a JSON header, then each chunk's body:
+    - `chunk`: the chunk size in tiles. Chunk (cx, cy) has tiles cx * chunk <= xidx < (cx + 1) * chunk,
+      and likewise for y; tile (xidx, yidx) is at (50 * xidx, 50 * yidx), as in `loadmap`.
+    - `index`: `"cx,cy"` -> `[offset, length]` of the chunk's body, in bytes from the end of the header.
+      Chunks without static entities are left out.
+    - `dynamic`: `[char, xidx, yidx]` for each dynamic entity. There are few of them, and they
+      exist whether or not anyone is near, so they're all read with the header.
+    A body is the chunk's lines of the map, with only static entities' characters.
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+    ...     _ = f.write("wwww\\nw c \\ntwww")
+    >>> write_chunked_map(f.name, f.name + ".chunks", chunk=16)
+    >>> cm = ChunkedMap(f.name + ".chunks")
+    >>> cm.chunk, cm.dynamic, list(cm.index)
+    (16, [['c', -8, -9]], [(-1, -1)])
+
+    The map starts at tile (-10, -10), 6 tiles into chunk (-1, -1) each way:
+    >>> cm.read(-1, -1).splitlines()[6:]
+    ['      wwww', '      w', '      twww']
+    >>> chunk = cm.load(-1, -1)
+    >>> len(chunk.static), chunk.blocked.passable(-500, -450), chunk.blocked.passable(-450, -450)
+    (9, False, True)
+    >>> os.remove(f.name); os.remove(f.name + ".chunks")
+    """
+    with open(textmap, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    rows: "dict[tuple[int, int], list[list[str]]]" = {}
+    dynamic = []
+    xindexes = range(-10, len(lines[0]) if lines else 0)  # same as `loadmap`
+    for yidx, line in zip(range(-10, len(lines)), lines):
+        for xidx, char in zip(xindexes, line):
+            if char in STATIC_CHARS:
+                key = (xidx // chunk, yidx // chunk)
+                if key not in rows:
+                    rows[key] = [[" "] * chunk for _ in range(chunk)]
+                rows[key][yidx % chunk][xidx % chunk] = char
+            elif char != " ":
+                dynamic.append([char, xidx, yidx])
+    index = {}
+    bodies = []
+    offset = 0
+    for (cx, cy), chars in sorted(rows.items()):
+        body = "\n".join("".join(row).rstrip() for row in chars).rstrip("\n").encode()
+        index[f"{cx},{cy}"] = [offset, len(body)]
+        bodies.append(body)
+        offset += len(body)
+    header = json.dumps({"chunk": chunk, "index": index, "dynamic": dynamic}).encode()
+    with open(filename, "wb") as f:
+        f.write(_CHUNKED_MAGIC + str(len(header)).encode() + b"\n" + header)
+        f.write(b"".join(bodies))
+
+
+@dataclass
+class MapChunk:
+    """The static entities of one chunk of a `ChunkedMap`, and the tiles they block."""
+    static: "dict[str, Entity]"
+    blocked: "Occupancy"
+    layer: "StaticLayer | None" = None
+    """`static`, encoded on first use (see `GameState.static_chunk_layer`)"""
+
+
+class ChunkedMap:
+    """A map written by `write_chunked_map`. Opening it reads only the header;
+    each chunk is read when asked for, so this is safe to use from several threads."""
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            magic, length = f.readline().split()
+            if magic + b" " != _CHUNKED_MAGIC:
+                raise ValueError(f"{filename} is not a chunked map")
+            header = json.loads(f.read(int(length)))
+            self.__bodies_start = f.tell()
+        self.chunk: int = header["chunk"]
+        self.dynamic: "list[list]" = header["dynamic"]
+        self.index: "dict[tuple[int, int], tuple[int, int]]" = {
+            tuple(map(int, key.split(","))): tuple(span) for key, span in header["index"].items()  # type: ignore
+        }
+
+    def read(self, cx: int, cy: int) -> str:
+        """The body of chunk (cx, cy), or "" if it has no static entities."""
+        if (cx, cy) not in self.index:
+            return ""
+        offset, length = self.index[cx, cy]
+        with open(self.filename, "rb") as f:
+            f.seek(self.__bodies_start + offset)
+            return f.read(length).decode()
+
+    def load(self, cx: int, cy: int) -> MapChunk:
+        """The entities of chunk (cx, cy)"""
+        n = self.chunk
+        static: "dict[str, Entity]" = {}
+        blocked = Occupancy(cx * n, cy * n, n, n)
+        for yidx, line in enumerate(self.read(cx, cy).splitlines(), cy * n):
+            for xidx, char in enumerate(line, cx * n):
+                if map_entity(char, xidx, yidx, static, {}):
+                    blocked.block(50*xidx, 50*yidx)
+        return MapChunk(static, blocked)
+
+
+class MapChunks:
+    """The chunks of a `ChunkedMap` near players, so memory use depends on where players are
+    rather than how big the world is. Call `follow` every tick with the players' positions:
+    the chunk each one is in is loaded straight away, the rest within `radius` chunks in the
+    background, and once more than `capacity` are loaded, those used least recently are dropped.
+
+    Has `Occupancy`'s `passable` and `passable_many`, so it can stand in for one. A chunk
+    that isn't loaded (yet) is impassable, as the players' own chunks always are.
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+    ...     _ = f.write("\\n".join("w" * 40 for _ in range(40)))
+    >>> write_chunked_map(f.name, f.name + ".chunks", chunk=10)
+    >>> mc = MapChunks(ChunkedMap(f.name + ".chunks"), capacity=4, background=False)
+    >>> mc.chunk_of(0, 0), mc.chunk_of(-1, 499)
+    ((0, 0), (-1, 0))
+    >>> mc.passable(0, 0), mc.passable(5000, 0)
+    (False, True)
+    >>> mc.follow(np.array([0]), np.array([0]))
+    >>> sorted(mc.loaded())
+    [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+    Moving away, the chunks left behind go first:
+    >>> mc.follow(np.array([1000]), np.array([1000]))
+    >>> sorted(mc.loaded())
+    [(1, 1), (1, 2), (2, 1), (2, 2)]
+    >>> mc.passable_many(np.array([1000, 0, 5000]), np.array([1000, 0, 0]))
+    array([False, False,  True])
+    >>> mc.cached(0, 0) is None, mc.cached(1, 1) is not None
+    (True, True)
+    >>> os.remove(f.name); os.remove(f.name + ".chunks")
+    """
+    def __init__(self, chunked: ChunkedMap, radius = 1, capacity = 64, background = True):
+        """`capacity` is a soft limit: chunks within `radius` of a player are never dropped."""
+        self.map = chunked
+        self.radius = radius
+        self.capacity = capacity
+        self.px = chunked.chunk * 50
+        """chunk size in pixels"""
+        self.__loaded: "OrderedDict[tuple[int, int], MapChunk]" = OrderedDict()
+        """least recently wanted first"""
+        self.__pending: "dict[tuple[int, int], Future]" = {}
+        self.__executor = ThreadPoolExecutor(1, thread_name_prefix="mapchunks") if background else None
+
+    def chunk_of(self, x: int, y: int) -> "tuple[int, int]":
+        return x // self.px, y // self.px
+
+    def loaded(self) -> "list[tuple[int, int]]":
+        return list(self.__loaded)
+
+    def get(self, cx: int, cy: int) -> "MapChunk | None":
+        """Chunk (cx, cy), loading it now if need be, or None if it has no static entities."""
+        if (cx, cy) not in self.map.index:
+            return None
+        if (cx, cy) not in self.__loaded:
+            pending = self.__pending.pop((cx, cy), None)
+            self.__loaded[cx, cy] = pending.result() if pending else self.map.load(cx, cy)
+        return self.__loaded[cx, cy]
+
+    def cached(self, cx: int, cy: int) -> "MapChunk | None":
+        """Chunk (cx, cy) if it's loaded, without loading it or counting it as used."""
+        return self.__loaded.get((cx, cy))
+
+    def follow(self, xs: np.ndarray, ys: np.ndarray):
+        """Load the chunks around players at (xs, ys), and drop ones far from all of them."""
+        for key, pending in list(self.__pending.items()):
+            if pending.done():
+                self.__loaded[key] = pending.result()
+                del self.__pending[key]
+        own = set(zip((xs // self.px).tolist(), (ys // self.px).tolist()))
+        for key in own:
+            self.get(*key)
+        r = self.radius
+        wanted = {(cx + dx, cy + dy) for cx, cy in own for dx in range(-r, r + 1) for dy in range(-r, r + 1)}
+        wanted &= self.map.index.keys()
+        for key in wanted:
+            if key in self.__loaded:
+                self.__loaded.move_to_end(key)
+            elif self.__executor is None:
+                self.get(*key)
+            elif key not in self.__pending:
+                self.__pending[key] = self.__executor.submit(self.map.load, *key)
+        while len(self.__loaded) > self.capacity:
+            oldest = next(iter(self.__loaded))
+            if oldest in wanted:
+                break
+            del self.__loaded[oldest]
+
+    def passable(self, x: int, y: int) -> bool:
+        key = self.chunk_of(x, y)
+        if key not in self.map.index:
+            return True
+        chunk = self.__loaded.get(key)
+        return chunk is not None and chunk.blocked.passable(x, y)
+
+    def passable_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """`passable` for arrays of positions, a chunk at a time."""
+        result = np.ones(len(xs), bool)
+        cxs, cys = xs // self.px, ys // self.px
+        for cx, cy in set(zip(cxs.tolist(), cys.tolist())):
+            if (cx, cy) not in self.map.index:
+                continue
+            here = (cxs == cx) & (cys == cy)
+            chunk = self.__loaded.get((cx, cy))
+            result[here] = chunk.blocked.passable_many(xs[here], ys[here]) if chunk else False
+        return result
+
+
+def diff_states(old: dict, new: dict) -> dict:
+    """What changed between two `GameState.snapshot()`s.
+    Changed or added items are sent whole; removed ones are listed by key.
+    >>> old = {"dynamic": {"c": {"x": 0}}, "players": {"a": {"x": 0}, "b": {"x": 5}}}
+    >>> new = {"dynamic": {"c": {"x": 0}}, "players": {"a": {"x": 50}}}
+    >>> diff_states(old, new)
+    {'dynamic': {}, 'players': {'a': {'x': 50}}, 'removed': {'players': ['b']}}
+    >>> diff_states(new, new)
+    {'dynamic': {}, 'players': {}}
+    """
+    patch = {}
+    removed = {}
+    for section in ["dynamic", "players"]:
+        before, after = old[section], new[section]
+        patch[section] = {k: v for k, v in after.items() if before.get(k) != v}
+        gone = [k for k in before if k not in after]
+        if gone:
+            removed[section] = gone
+    if removed:
+        patch["removed"] = removed
+    return patch
+
+
+_POS_HEADER = struct.Struct("<BIIII")
+"""frame kind (always 1), tick seq, number of records, server time in ms (see `TickFrames.push`),
+inputs acknowledged (see `with_ack`; 0 until it's stamped for one client)"""
+_POS_RECORD = struct.Struct("<10siic")
+"""client id, x, y, facing direction"""
+_POSITION_KEYS = ("x", "y", "facing_direction")
+
+
+def pack_positions(seq: int, players: "dict[str, dict]", t = 0) -> bytes:
+    """Every player's id/x/y/facing in a compact binary layout (little-endian,
+    see `_POS_HEADER` and `_POS_RECORD`), for clients using the binary wire format.
+    `players` is the "players" section of `GameState.snapshot()`.
+    >>> b = pack_positions(7, {"abcdefghij": {"x": 500, "y": -50, "facing_direction": "w"}})
+    >>> len(b)
+    36
+    >>> unpack_positions(b)
+    (7, {'abcdefghij': (500, -50, 'w')})
+    """
+    buf = bytearray(_POS_HEADER.size + _POS_RECORD.size * len(players))
+    _POS_HEADER.pack_into(buf, 0, 1, seq, len(players), t & 0xFFFFFFFF, 0)
+    offset = _POS_HEADER.size
+    for cid, p in players.items():
+        _POS_RECORD.pack_into(buf, offset, cid.encode(), p["x"], p["y"], p["facing_direction"].encode())
+        offset += _POS_RECORD.size
+    return bytes(buf)
+
+
+def unpack_positions(b: bytes):
+    """Inverse of `pack_positions`. Returns `(seq, {cid: (x, y, facing)})`"""
+    _kind, seq, count, _t, _ack = _POS_HEADER.unpack_from(b, 0)
+    players = {}
+    for i in range(count):
+        cid, x, y, facing = _POS_RECORD.unpack_from(b, _POS_HEADER.size + i * _POS_RECORD.size)
+        players[cid.rstrip(b"\0").decode()] = (x, y, facing.decode())
+    return seq, players
+
+
+def with_ack(msg: "str | bytes", ack: int) -> "str | bytes":
+    """A copy of `msg` (a tick message from `TickFrames`) telling one client that the tick
+    reflects the first `ack` messages it sent. Tick messages are encoded once for everyone,
+    so the ack is spliced into a copy rather than encoded with them.
+    >>> with_ack('{"frame": "patch", "seq": 2}', 5)
+    '{"ack": 5, "frame": "patch", "seq": 2}'
+    >>> with_ack(pack_positions(2, {}), 5)[-4:]
+    b'\\x05\\x00\\x00\\x00'
+    """
+    if type(msg) == bytes:
+        buf = bytearray(msg)
+        struct.pack_into("<I", buf, _POS_HEADER.size - 4, ack)
+        return bytes(buf)
+    return '{"ack": %d, ' % ack + msg[1:]  # type: ignore
+
+
+def without_positions(snap: dict) -> dict:
+    """`snap` with the fields carried by `pack_positions` removed from each player."""
+    players = {
+        cid: {k: v for k, v in p.items() if k not in _POSITION_KEYS}
+        for cid, p in snap["players"].items()
+    }
+    return {"dynamic": snap["dynamic"], "players": players}
+
+
+class Spans:
+    """Durations of the named phases of recent ticks, for finding where the time goes.
+    Off by default, in which case `start` and `end` do next to nothing.
+    >>> spans = Spans()
+    >>> started = spans.start()
+    >>> spans.end("step", started)
+    >>> spans.todict()
+    {}
+    >>> spans.enabled = True
+    >>> for ms in [1, 2, 3, 4]:
+    ...     spans.record("step", ms / 1000)
+    >>> spans.todict()
+    {'step': {'count': 4, 'p50_ms': 3.0, 'p95_ms': 4.0, 'p99_ms': 4.0, 'max_ms': 4.0}}
+    """
+    def __init__(self, window = 300):
+        """Percentiles are over the last `window` samples of each phase."""
+        self.enabled = False
+        self.window = window
+        self.__samples: "dict[str, deque[float]]" = {}
+
+    def start(self) -> float:
+        return time.perf_counter() if self.enabled else 0.0
+
+    def end(self, name: str, started: float):
+        if self.enabled:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name: str, seconds: float):
+        samples = self.__samples.get(name)
+        if samples is None:
+            samples = self.__samples[name] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def todict(self):
+        result = {}
+        for name, samples in self.__samples.items():
+            ordered = sorted(samples)
+            def pct(p):
+                return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+            result[name] = {"count": len(ordered), "p50_ms": pct(50), "p95_ms": pct(95),
+                            "p99_ms": pct(99), "max_ms": round(ordered[-1] * 1000, 3)}
+        return result
+
+
+class TickFrames:
+    """Turns each tick's snapshot into the message a client should get:
+    - a "patch" with only what changed, if the client got the previous tick
+    - a "key" frame with everything otherwise (new clients, and every `keyframe_every` ticks)
+
+    Each message kind is encoded at most once per tick, however many clients ask for it.
+    Messages carry the tick's "seq", and its server time "t" if `push` was given one.
+    >>> tf = TickFrames(keyframe_every=3)
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 0}}})
+    >>> tf.for_client(None)
+    '{"frame": "key", "seq": 1, "dynamic": {}, "players": {"a": {"x": 0}}}'
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 50}}})
+    >>> tf.for_client(1)
+    '{"frame": "patch", "seq": 2, "dynamic": {}, "players": {"a": {"x": 50}}}'
+
+    Nothing changed, so there's nothing to send:
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 50}}})
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 50}}})
+    >>> tf.for_client(3) is None
+    True
+
+    A client that skipped some ticks gets a patch from the last one it got,
+    as long as that's one of the last `history` ticks:
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 100}}})
+    >>> tf.for_client(2)
+    '{"frame": "patch", "seq": 5, "dynamic": {}, "players": {"a": {"x": 100}}}'
+
+    Every `keyframe_every` ticks, everyone gets a keyframe:
+    >>> tf.push({"dynamic": {}, "players": {}})
+    >>> tf.for_client(5)
+    '{"frame": "key", "seq": 6, "dynamic": {}, "players": {}}'
+
+    Clients using the binary wire format get positions as bytes, and
+    JSON only when something else changed:
+    >>> tf.push({"dynamic": {}, "players": {"abcdefghij": {"x": 0, "y": 0, "facing_direction": "d", "name": "abc"}}})
+    >>> tf.for_binary_client(6)
+    ['{"frame": "patch", "seq": 7, "dynamic": {}, "players": {"abcdefghij": {"name": "abc"}}}', b'...']
+    >>> tf.push({"dynamic": {}, "players": {"abcdefghij": {"x": 50, "y": 0, "facing_direction": "d", "name": "abc"}}})
+    >>> tf.for_binary_client(7)
+    [b'...']
+    """
+    INTEREST_CELL = 250
+    """Size in px of the cells used by `near`. Much bigger than the 50-px map grid, so that
+    a whole viewport is only a few cells."""
+
+    def __init__(self, keyframe_every = 90, history = 30):
+        self.keyframe_every = keyframe_every
+        self.seq = 0
+        self.t: "int | None" = None
+        self.__prev = {"dynamic": {}, "players": {}}
+        self.__snap = self.__prev
+        self.__history_len = history
+        self.__history: "dict[int, dict]" = {}
+        """seq -> snapshot, for the last `history` ticks before this one"""
+        self.__since_json: "dict[int, str | None]" = {}
+        """patches from older ticks, by the older tick's seq, encoded this tick"""
+        self.__meta_since_json: "dict[int, str | None]" = {}
+        self.__key_json: "str | None" = None
+        self.__patch_json: "str | None" = None
+        self.__patch_empty = False
+        self.__meta_prev: "dict | None" = None
+        self.__meta_snap: "dict | None" = None
+        self.__meta_json: "str | None" = None
+        self.__meta_empty = False
+        self.__pos_prev: "bytes | None" = None
+        self.__pos: "bytes | None" = None
+        self.__cells: "dict[tuple[int, int], list[tuple[str, str, dict]]] | None" = None
+        self.__moving_cells: "dict[tuple[int, int], list[dict]] | None" = None
+        self.__moving_cell = 0
+
+    def push(self, snap: dict, t: "int | None" = None):
+        """Start a new tick with `snap` (from `GameState.snapshot()`). `t` is the server time
+        in ms, which clients use to interpolate between ticks; any fixed origin will do.
+        >>> tf = TickFrames()
+        >>> tf.push({"dynamic": {}, "players": {}}, t=1000)
+        >>> tf.keyframe()
+        '{"frame": "key", "seq": 1, "t": 1000, "dynamic": {}, "players": {}}'
+        """
+        self.__history[self.seq] = self.__snap
+        self.__history.pop(self.seq - self.__history_len, None)
+        self.seq += 1
+        self.t = t
+        self.__prev, self.__snap = self.__snap, snap
+        self.__since_json = {}
+        self.__meta_since_json = {}
+        self.__key_json = None
+        self.__patch_json = None
+        self.__patch_empty = False
+        self.__meta_prev, self.__meta_snap = self.__meta_snap, None
+        self.__meta_json = None
+        self.__meta_empty = False
+        self.__pos_prev, self.__pos = self.__pos, None
+        self.__cells = None
+        self.__moving_cells = None
+
+    def stamp(self) -> dict:
+        """The fields that identify this tick in every message"""
+        if self.t is None:
+            return {"seq": self.seq}
+        return {"seq": self.seq, "t": self.t}
+
+    def keyframe(self) -> str:
+        if self.__key_json is None:
+            self.__key_json = json.dumps({"frame": "key", **self.stamp(), **self.__snap})
+        return self.__key_json
+
+    def patch(self) -> "str | None":
+        """None if nothing changed since the previous tick"""
+        if self.__patch_json is None and not self.__patch_empty:
+            diff = diff_states(self.__prev, self.__snap)
+            if diff["dynamic"] or diff["players"] or "removed" in diff:
+                self.__patch_json = json.dumps({"frame": "patch", **self.stamp(), **diff})
+            else:
+                self.__patch_empty = True
+        return self.__patch_json
+
+    def patch_since(self, last_seq: int) -> "str | None":
+        """Like `patch`, but from tick `last_seq` (one of the last `history` ticks) to this one.
+        Each starting tick's patch is encoded at most once per tick."""
+        if last_seq == self.seq - 1:
+            return self.patch()
+        if last_seq not in self.__since_json:
+            diff = diff_states(self.__history[last_seq], self.__snap)
+            changed = diff["dynamic"] or diff["players"] or "removed" in diff
+            self.__since_json[last_seq] = json.dumps({"frame": "patch", **self.stamp(), **diff}) if changed else None
+        return self.__since_json[last_seq]
+
+    def positions(self) -> bytes:
+        if self.__pos is None:
+            self.__pos = pack_positions(self.seq, self.__snap["players"], self.t or 0)
+        return self.__pos
+
+    def meta_patch(self) -> "str | None":
+        """Like `patch`, but ignoring the fields that `positions` carries."""
+        if self.__meta_json is None and not self.__meta_empty:
+            if self.__meta_prev is None:
+                self.__meta_prev = without_positions(self.__prev)
+            self.__meta_snap = without_positions(self.__snap)
+            diff = diff_states(self.__meta_prev, self.__meta_snap)
+            if diff["dynamic"] or diff["players"] or "removed" in diff:
+                self.__meta_json = json.dumps({"frame": "patch", **self.stamp(), **diff})
+            else:
+                self.__meta_empty = True
+        return self.__meta_json
+
+    def meta_patch_since(self, last_seq: int) -> "str | None":
+        """`meta_patch` from tick `last_seq`, like `patch_since`"""
+        if last_seq == self.seq - 1:
+            return self.meta_patch()
+        if last_seq not in self.__meta_since_json:
+            diff = diff_states(without_positions(self.__history[last_seq]), without_positions(self.__snap))
+            changed = diff["dynamic"] or diff["players"] or "removed" in diff
+            self.__meta_since_json[last_seq] = json.dumps({"frame": "patch", **self.stamp(), **diff}) if changed else None
+        return self.__meta_since_json[last_seq]
+
+    def player(self, cid: str) -> "dict | None":
+        """This tick's snapshot of one player"""
+        return self.__snap["players"].get(cid)
+
+    def near(self, x: int, y: int, half_w: int, half_h: int) -> "dict[str, dict[str, dict]]":
+        """The part of this tick's snapshot within `half_w`/`half_h` of (x, y).
+        Only the interest cells overlapping that rectangle are looked at.
+        >>> tf = TickFrames()
+        >>> tf.push({"dynamic": {"c": {"x": 900, "y": 0}}, "players": {"a": {"x": 0, "y": 0}, "b": {"x": 5000, "y": 0}}})
+        >>> tf.near(0, 0, 500, 500)
+        {'dynamic': {}, 'players': {'a': {'x': 0, 'y': 0}}}
+        >>> tf.near(1000, 0, 500, 500)
+        {'dynamic': {'c': {'x': 900, 'y': 0}}, 'players': {}}
+        """
+        size = self.INTEREST_CELL
+        if self.__cells is None:
+            self.__cells = {}
+            for section in ["dynamic", "players"]:
+                for k, d in self.__snap[section].items():
+                    self.__cells.setdefault((d["x"] // size, d["y"] // size), []).append((section, k, d))
+        found: "dict[str, dict[str, dict]]" = {"dynamic": {}, "players": {}}
+        for cy in range((y - half_h) // size, (y + half_h) // size + 1):
+            for cx in range((x - half_w) // size, (x + half_w) // size + 1):
+                for section, k, d in self.__cells.get((cx, cy), []):
+                    if abs(d["x"] - x) <= half_w and abs(d["y"] - y) <= half_h:
+                        found[section][k] = d
+        return found
+
+    def moving_near(self, x: int, y: int, half_w: int, half_h: int) -> bool:
+        """Whether any player within `half_w`/`half_h` of (x, y) is moving. Cheaper than `near`:
+        only the moving players are indexed, in cells big enough that at most 4 are looked at.
+        >>> tf = TickFrames()
+        >>> tf.push({"dynamic": {}, "players": {"a": {"x": 0, "y": 0, "change_x": 50}, "b": {"x": 5000, "y": 0}}})
+        >>> tf.moving_near(500, 0, 500, 500), tf.moving_near(5000, 0, 500, 500)
+        (True, False)
+        """
+        size = 2 * max(half_w, half_h)
+        if self.__moving_cells is None or size != self.__moving_cell:
+            self.__moving_cells = {}
+            self.__moving_cell = size
+            for p in self.__snap["players"].values():
+                if p.get("change_x") or p.get("change_y"):
+                    self.__moving_cells.setdefault((p["x"] // size, p["y"] // size), []).append(p)
+        if not self.__moving_cells:
+            return False
+        for cy in range((y - half_h) // size, (y + half_h) // size + 1):
+            for cx in range((x - half_w) // size, (x + half_w) // size + 1):
+                for p in self.__moving_cells.get((cx, cy), ()):
+                    if abs(p["x"] - x) <= half_w and abs(p["y"] - y) <= half_h:
+                        return True
+        return False
+
+    def _in_sync(self, last_seq: "int | None"):
+        return last_seq in self.__history and self.seq % self.keyframe_every != 0
+
+    def for_client(self, last_seq: "int | None") -> "str | None":
+        """The message for a client whose last received tick was `last_seq`
+        (None if it hasn't received one yet). None means there's nothing to send."""
+        if self._in_sync(last_seq):
+            return self.patch_since(last_seq)  # type: ignore
+        return self.keyframe()
+
+    def for_binary_client(self, last_seq: "int | None") -> "list[str | bytes]":
+        """Like `for_client`, but for clients using the binary wire format.
+        Returns the messages to send, in order (possibly none)."""
+        if not self._in_sync(last_seq):
+            return [self.keyframe()]
+        msgs: "list[str | bytes]" = []
+        meta = self.meta_patch_since(last_seq)  # type: ignore
+        if meta is not None:
+            msgs.append(meta)
+        pos = self.positions()
+        if (last_seq != self.seq - 1 or self.__pos_prev is None
+                or pos[_POS_HEADER.size:] != self.__pos_prev[_POS_HEADER.size:]):
+            msgs.append(pos)
+        return msgs
+
+
+class AreaOfInterest:
+    """What one client can see: a `width` x `height` rectangle (its viewport, plus one tile
+    of margin) centred on its player. Remembers what the client was sent, so each tick only
+    sends what changed inside the rectangle. Things that cross into it are listed in
+    "entered" (and sent whole); things that leave it are listed in "removed".
+
+    Because it compares against what was actually sent, skipped ticks don't matter.
+    >>> tf = TickFrames()
+    >>> aoi = AreaOfInterest("a", 1000, 1000)
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 0, "y": 0}, "b": {"x": 600, "y": 0}}})
+    >>> aoi.render(tf)
+    '{"frame": "key", "seq": 1, "dynamic": {}, "players": {"a": {"x": 0, "y": 0}}}'
+
+    "b" walks into view:
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 0, "y": 0}, "b": {"x": 550, "y": 0}}})
+    >>> aoi.render(tf)
+    '{"frame": "patch", "seq": 2, "dynamic": {}, "players": {"b": {"x": 550, "y": 0}}, "entered": {"players": ["b"]}}'
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 0, "y": 0}, "b": {"x": 550, "y": 0}}})
+    >>> aoi.render(tf) is None
+    True
+
+    ...and back out again:
+    >>> tf.push({"dynamic": {}, "players": {"a": {"x": 0, "y": 0}, "b": {"x": 600, "y": 0}}})
+    >>> aoi.render(tf)
+    '{"frame": "patch", "seq": 4, "dynamic": {}, "players": {}, "removed": {"players": ["b"]}}'
+    """
+    def __init__(self, cid: str, width: int, height: int, margin = 50):
+        self.cid = cid
+        self.half_w = width // 2 + margin
+        self.half_h = height // 2 + margin
+        self.__sent: "dict[str, dict[str, dict]] | None" = None
+
+    def render(self, frames: TickFrames) -> "str | None":
+        """The message to send for the latest tick in `frames`, or None if there's nothing new."""
+        me = frames.player(self.cid)
+        if me is None:
+            visible: "dict[str, dict[str, dict]]" = {"dynamic": {}, "players": {}}
+        else:
+            visible = frames.near(me["x"], me["y"], self.half_w, self.half_h)
+        sent, self.__sent = self.__sent, visible
+        if sent is None:
+            return json.dumps({"frame": "key", **frames.stamp(), **visible})
+        diff = diff_states(sent, visible)
+        entered = {}
+        for section in ["dynamic", "players"]:
+            new = [k for k in diff[section] if k not in sent[section]]
+            if new:
+                entered[section] = new
+        if entered:
+            diff["entered"] = entered
+        if not (diff["dynamic"] or diff["players"] or "removed" in diff):
+            return None
+        return json.dumps({"frame": "patch", **frames.stamp(), **diff})
+
+
+@dataclass(frozen=True)
+class StaticLayer:
+    """The static entities, encoded once for every client: the JSON (`{"static": {...}}`),
+    the same gzipped, and a version id that changes whenever the JSON does.
+    >>> layer = StaticLayer.encode({"a": Entity(0, 0, "wall", "/assets/wall.png", False)})
+    >>> layer.version
+    '...'
+    >>> json.loads(gzip.decompress(layer.gzipped)) == json.loads(layer.json)
+    True
+    >>> StaticLayer.encode({}).version == layer.version
+    False
+    """
+    version: str
+    json: str
+    gzipped: bytes
+
+    @staticmethod
+    def encode(static: "dict[str, Entity]", **extra) -> "StaticLayer":
+        """`extra` items are added to the JSON alongside "static"."""
+        text = json.dumps({"static": {k: v.todict() for k, v in static.items()}, **extra})
+        data = text.encode()
+        return StaticLayer(hashlib.sha1(data).hexdigest()[:16], text, gzip.compress(data, mtime=0))
 
 
 @dataclass
 class GameState:
     """Examples in docstring/doctests for module"""
-    __players: "dict[str, Player]" 
+    __players: PlayerTable
     __dynamic: "dict[str, Entity]"
     __static: "dict[str, Entity]"
-    def __init__(self, create_entities = True):
-        """Can specify create_entities = False if you want no entities, which can be useful for doctests."""
-        self.__players = {} 
+    __grid: SpatialGrid
+    """dynamic entities only; static ones are in `__blocked`"""
+    __blocked: "Occupancy | MapChunks"
+    __missions: MissionCatalogue
+    __spawns: "list[tuple[int, int]]"
+    __inbox: "dict[str, list[CliEvent | Disconnect]]"
+    """client id -> its events since the last tick, in order"""
+    __static_layer: "StaticLayer | None"
+    MAX_INPUTS_PER_TICK = 8
+    """per client. Further events before the next tick are dropped (but never a Disconnect)."""
+    def __init__(self, create_entities = True, mapfile = "map.txt", missionsfile = "missions.toml",
+                 region: "tuple[int, int] | None" = None, spawns: "list[tuple[int, int]] | None" = None,
+                 spans: "Spans | None" = None):
+        """Can specify create_entities = False if you want no entities or missions, which can be useful for doctests.
+        - `mapfile`: a text map, or one written by `write_chunked_map`, whose static entities are
+          then only loaded near players (see `MapChunks`). Either way, see `loadmap`.
+        - `region`: (x0, x1). Only load entities with x0 <= x < x1, plus one tile either side,
+          so a shard (see srv6_shards.py) has what it needs for collisions at its edges.
+          Walls etc. are blocked everywhere regardless; that's only one bit per tile.
+        - `spawns`: where new players appear, in turn. Defaults to (500, 500).
+        - `spans`: where to time the phases of each tick. Pass in an enabled `Spans` to profile."""
+        self.spans = spans or Spans()
+        self.__players = PlayerTable()
+        self.__inbox = {}
+        self.dropped_inputs = 0
+        """events dropped because a client went over MAX_INPUTS_PER_TICK"""
         if create_entities:
-            self.__static, self.__dynamic = loadmap("map.txt")
+            self.__static, self.__dynamic, self.__blocked = loadmap(mapfile)
+            self.__missions = MissionCatalogue(missionsfile)
         else:
             self.__static, self.__dynamic = {}, {}
+            self.__blocked = Occupancy(0, 0, 0, 0)
+            self.__missions = MissionCatalogue()
+        if region is not None:
+            x0, x1 = region[0] - 50, region[1] + 50
+            self.__static = {k: e for k, e in self.__static.items() if x0 <= e.x < x1}
+            self.__dynamic = {k: e for k, e in self.__dynamic.items() if x0 <= e.x < x1}
+        self.__spawns = list(spawns or [(500, 500)])
+        self.__grid = SpatialGrid()
+        for k, e in self.__dynamic.items():
+            self.__grid.add(k, e)
+        self.__static_layer = None
+
+    def static_layer(self) -> StaticLayer:
+        """The static entities, encoded on first use. Static entities don't change after
+        loading; anything that changes them must reset `__static_layer`.
+        With a chunked map, there are none here; instead `chunk_px` says how big chunks are,
+        and each one's static entities are in `static_chunk_layer`."""
+        if self.__static_layer is None:
+            if isinstance(self.__blocked, MapChunks):
+                self.__static_layer = StaticLayer.encode({}, chunk_px=self.__blocked.px)
+            else:
+                self.__static_layer = StaticLayer.encode(self.__static)
+        return self.__static_layer
+
+    def static_chunk_layer(self, cx: int, cy: int) -> "StaticLayer | None":
+        """The static entities of chunk (cx, cy) of a chunked map, or None for a text map.
+        A chunk that isn't loaded is read from the file but not kept, since which chunks stay
+        loaded is up to `MapChunks.follow`. That makes this safe to call from another thread.
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        ...     _ = f.write("wwww\\nw c \\ntwww")
+        >>> write_chunked_map(f.name, f.name + ".chunks")
+        >>> gs = GameState(mapfile=f.name + ".chunks")
+        >>> json.loads(gs.static_layer().json)
+        {'static': {}, 'chunk_px': 1600}
+        >>> len(json.loads(gs.static_chunk_layer(-1, -1).json)["static"]), gs.static_chunk_layer(0, 0).json
+        (9, '{"static": {}}')
+        >>> GameState(create_entities=False).static_chunk_layer(0, 0) is None
+        True
+        >>> os.remove(f.name); os.remove(f.name + ".chunks")
+        """
+        if not isinstance(self.__blocked, MapChunks):
+            return None
+        chunk = self.__blocked.cached(cx, cy) or self.__blocked.map.load(cx, cy)
+        if chunk.layer is None:
+            chunk.layer = StaticLayer.encode(chunk.static)
+        return chunk.layer
 
     def get_static(self):
-        staticdict = {k: v.todict() for k, v in self.__static.items()}
-        return json.dumps({
-            "static": staticdict
-        })
+        return self.static_layer().json
     
     def process_cli_msg(self, ce: 'CliEvent | Disconnect'):
-        """Update state based an event or a disconnect"""
-        if type(ce) == Disconnect:
-            self.handleDC(ce)
-        elif type(ce) == CliEvent:
-            self.handleCE(ce)
-        else:
+        """Queue an event or a disconnect, to update state on the next tick (see `apply_inputs`).
+        Raises BadPayload straight away if the event is malformed.
+
+        Only the state at tick time matters, so an event that's the same as the one
+        before it from that client (e.g. key repeat) is dropped. Past MAX_INPUTS_PER_TICK,
+        the oldest key event whose effects later ones overwrite (see `key_effects`)
+        is dropped to make room:
+        >>> gs = GameState(create_entities=False)
+        >>> gs.process_cli_msg(CliEvent("abc", '{"eventkind": "init", "name": "abc", "avatar": ""}'))
+        >>> for _i in range(20):
+        ...     gs.process_cli_msg(CliEvent("abc", '{"eventkind": "keydown", "key": "w"}'))
+        >>> gs.process_cli_msg(CliEvent("abc", '{"eventkind": "keyup", "key": "w"}'))
+        >>> gs.process_cli_msg(CliEvent("abc", '{"eventkind": "keydown", "key": " "}'))
+        >>> len(gs.pending_inputs("abc")), gs.dropped_inputs
+        (4, 0)
+        >>> for key in "wasdwasw":
+        ...     gs.process_cli_msg(CliEvent("abc", '{"eventkind": "keydown", "key": "%s"}' % key))
+        >>> len(gs.pending_inputs("abc")), gs.dropped_inputs
+        (8, 4)
+
+        So a keyup after the burst still stops the player:
+        >>> gs.process_cli_msg(CliEvent("abc", '{"eventkind": "keyup", "key": "w"}'))
+        >>> gs.pending_inputs("abc")[-1].payload_raw, gs.dropped_inputs
+        ('{"eventkind": "keyup", "key": "w"}', 5)
+
+        An event that changes nothing itself is the one dropped:
+        >>> gs2 = GameState(create_entities=False)
+        >>> gs2.process_cli_msg(CliEvent("abc", '{"eventkind": "init", "name": "abc", "avatar": ""}'))
+        >>> for button in "abababab":
+        ...     gs2.process_cli_msg(CliEvent("abc", '{"eventkind": "click", "button": "%s"}' % button))
+        >>> gs2.process_cli_msg(CliEvent("abc", '{"eventkind": "keyup", "key": "q"}'))
+        >>> len(gs2.pending_inputs("abc")), gs2.pending_inputs("abc")[-1].payload_raw, gs2.dropped_inputs
+        (8, '{"eventkind": "click", "button": "a"}', 2)
+        >>> gs.apply_inputs()
+        >>> p = gs.current()["players"]["abc"]
+        >>> p.change_x, p.change_y, p.facing_direction
+        (-50, 0, 'w')
+
+        Players end up the same as if nothing had been dropped:
+        >>> def burst(cap):
+        ...     rng = random.Random(1)
+        ...     gs = GameState(create_entities=False)
+        ...     gs.MAX_INPUTS_PER_TICK = cap
+        ...     gs.process_cli_msg(CliEvent("abc", '{"eventkind": "init", "name": "abc", "avatar": ""}'))
+        ...     for _tick in range(50):
+        ...         for _i in range(rng.randrange(30)):
+        ...             kind, key = rng.choice(["keydown", "keyup"]), rng.choice("wasd q")
+        ...             gs.process_cli_msg(CliEvent("abc", json.dumps({"eventkind": kind, "key": key})))
+        ...         gs.apply_inputs()
+        ...         p = gs.current()["players"]["abc"]
+        ...         yield p.change_x, p.change_y, p.facing_direction, p.trying_action
+        >>> list(burst(8)) == list(burst(1000))
+        True
+        """
+        if type(ce) == CliEvent:
+            ce.get_payload()
+        elif type(ce) != Disconnect:
             raise NotImplementedError()
+        events = self.__inbox.setdefault(ce.cid, [])
+        if events and events[-1] == ce:
+            return
+        if len(events) >= self.MAX_INPUTS_PER_TICK and type(ce) != Disconnect:
+            self.dropped_inputs += 1
+            i = self.__redundant_input(events + [ce])
+            if i is None or i == len(events):
+                return
+            del events[i]
+        events.append(ce)
+
+    @staticmethod
+    def __redundant_input(events: "list[CliEvent | Disconnect]") -> "int | None":
+        """Index of the oldest key event in `events` whose effects later ones overwrite, if any."""
+        overwritten: "set[str]" = set()
+        oldest = None
+        for i in range(len(events) - 1, -1, -1):
+            ce = events[i]
+            effects = key_effects(ce.get_payload()) if type(ce) == CliEvent else None
+            if effects is None:
+                continue
+            if effects <= overwritten:
+                oldest = i
+            overwritten |= effects
+        return oldest
+
+    def pending_inputs(self, cid: str) -> "list[CliEvent | Disconnect]":
+        """Events from this client waiting for the next tick"""
+        return list(self.__inbox.get(cid, []))
+
+    def apply_inputs(self):
+        """Update state based on every queued event and disconnect, in the order they
+        arrived from each client. Called at the start of each tick."""
+        inbox, self.__inbox = self.__inbox, {}
+        for cid, events in inbox.items():
+            for ce in events:
+                if type(ce) == Disconnect:
+                    self.handleDC(ce)
+                elif cid in self.__players or type(ce.get_payload()) == InitEv:
+                    self.handleCE(ce)
+                else:
+                    print("W: ignoring event from", cid, "before init:", ce.payload_raw)
 
     def handleDC(self, ce: Disconnect):
         """Remove this player's ID from self.__players"""
@@ -291,34 +1695,131 @@ class GameState:
         - Other events are passed to `handle_ce_impl`."""
         paylo = ce.get_payload()
         if type(paylo) == InitEv:
-            self.__players[ce.cid] = Player(500, 500, paylo.name, paylo.avatar)
+            self.__players[ce.cid] = self.new_player(paylo)
         else:
             handle_ce_impl(paylo, self.__players[ce.cid])
 
+    def new_player(self, paylo: InitEv) -> Player:
+        """A Player at the next spawn point"""
+        x, y = self.__spawns[0]
+        self.__spawns.append(self.__spawns.pop(0))
+        return Player(x, y, paylo.name, paylo.avatar)
+
+    def add_player(self, cid: str, p: Player):
+        """Take over a player from another GameState (see `pop_player`)"""
+        self.__players[cid] = p
+
+    def pop_player(self, cid: str) -> Player:
+        return self.__players.pop(cid)
+
+    def players_outside(self, x0: int, x1: int) -> "list[str]":
+        """IDs of players that aren't in x0 <= x < x1"""
+        t = self.__players
+        xs = t.x[:len(t)]
+        return [t.cids[row] for row in np.flatnonzero((xs < x0) | (xs >= x1))]
+
+    def put_dynamic(self, key: str, e: Entity):
+        """Add or move a dynamic entity. Use this rather than mutating `e.x`/`e.y`
+        directly so the spatial grid stays in sync."""
+        self.__dynamic[key] = e
+        self.__grid.add(key, e)
+
+    def remove_dynamic(self, key: str):
+        del self.__dynamic[key]
+        self.__grid.remove(key)
+
     def current(self):
         """Copy of current state. Examples in module docstring/doctests."""
-        return {"dynamic": copy.deepcopy(self.__dynamic), "players": copy.deepcopy(self.__players)}
+        return {"dynamic": copy.deepcopy(self.__dynamic), "players": self.__players.copy()}
+
+    def snapshot(self):
+        """Current state as plain dicts, ready for `json.dumps` or `diff_states`."""
+        return {
+            "dynamic": {k: v.todict() for k, v in self.__dynamic.items()},
+            "players": self.__players.todicts(),
+        }
 
     def jsondumps(self):
         """Current state in json. Examples in module docstring/doctests"""
-        dynamicdict = {k: v.todict() for k, v in self.__dynamic.items()}
-        playersdict = {k: v.todict() for k, v in self.__players.items()}
-        return json.dumps({
-            "dynamic": dynamicdict,
-            "players": playersdict,
-        })
+        return json.dumps(self.snapshot())
 
-    def tick(self):
-        """Move players based on their velocities, then return self.jsondump()"""
-        all_ents = list(self.__static.values()) + list(self.__dynamic.values())
-        for p in self.__players.values():
-            p.x += p.change_x
-            p.y += p.change_y
-            for e in all_ents:
+    def step(self, batched = True):
+        """Move players based on their velocities, and handle collisions and actions.
+        With `batched`, every player is moved and checked against static entities
+        with a few array operations; only players that are acting or share a cell
+        with a dynamic entity are then looked at one by one.
+        `batched = False` does everything one player at a time, which gives the same result:
+        >>> def play(batched, mapfile = "map.txt"):
+        ...     rng = random.Random(0)
+        ...     gs = GameState(mapfile=mapfile, spawns=[(500, 500), (600, 800), (650, 750)])
+        ...     for i in range(20):
+        ...         gs.process_cli_msg(CliEvent(f"p{i}", '{"eventkind": "init", "name": "p", "avatar": ""}'))
+        ...     gs.apply_inputs()
+        ...     for _ in range(300):
+        ...         kind, key = rng.choice(["keydown", "keyup"]), rng.choice("wasd ")
+        ...         gs.process_cli_msg(CliEvent(f"p{rng.randrange(20)}", json.dumps({"eventkind": kind, "key": key})))
+        ...         gs.apply_inputs()
+        ...         gs.step(batched)
+        ...     return gs.snapshot()
+        >>> play(True) == play(False)
+        True
+
+        So does a chunked copy of the map, with small chunks so that players move between them:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile(suffix=".chunks", delete=False) as f:
+        ...     chunked = f.name
+        >>> write_chunked_map("map.txt", chunked, chunk=4)
+        >>> play(True, chunked) == play(False, chunked) == play(True)
+        True
+        >>> os.remove(chunked)
+        """
+        t = self.__players
+        n = len(t)
+        spans = self.spans
+        if isinstance(self.__blocked, MapChunks):
+            started = spans.start()
+            # where players are moving to, so collisions there can be checked
+            self.__blocked.follow(t.x[:n] + t.change_x[:n], t.y[:n] + t.change_y[:n])
+            spans.end("follow_map", started)
+        started = spans.start()
+        if batched:
+            t.move()
+            spans.end("move", started)
+            started = spans.start()
+            xs, ys = t.x[:n], t.y[:n]
+            blocked = ~self.__blocked.passable_many(xs, ys)
+            xs[blocked] -= t.change_x[:n][blocked]
+            ys[blocked] -= t.change_y[:n][blocked]
+            busy = t.trying_action[:n] | self.__grid.occupied_many(xs, ys)
+            players = [t[t.cids[row]] for row in np.flatnonzero(busy)]
+            spans.end("collide_static", started)
+        else:
+            players = list(t.values())
+            for p in players:
+                p.x += p.change_x
+                p.y += p.change_y
+                handle_static_collisions(p, self.__blocked)
+            spans.end("move", started)
+        started = spans.start()
+        for p in players:
+            for e in self.__grid.at(p.x, p.y):
                 handle_collisions(p, e)
-                on_action(p, e)
-            p.trying_action = False
-        return self.jsondumps()
+            if p.trying_action:
+                for e in self.__grid.near(p.x, p.y):
+                    on_action(p, e, self.__missions)
+        t.trying_action[:n] = False
+        spans.end("collide_dynamic_and_act", started)
+
+    def tick(self):
+        """`apply_inputs`, `step`, then return self.snapshot(). Each phase is timed in `self.spans`."""
+        started = self.spans.start()
+        self.apply_inputs()
+        self.spans.end("apply_inputs", started)
+        self.step()
+        started = self.spans.start()
+        snap = self.snapshot()
+        self.spans.end("snapshot", started)
+        return snap
         
 """
 
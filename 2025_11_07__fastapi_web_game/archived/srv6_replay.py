@@ -0,0 +1,177 @@
+"""
+Recording client events from a live server, and replaying them as fast as possible.
+
+A `Recorder` appends every `CliEvent` and `Disconnect` that reaches the GameState
+to a file, each with the number of ticks that had happened when it arrived.
+Events are applied at the start of the next tick (see `GameState.apply_inputs`),
+so feeding the same events in before the same ticks, on the same map, gives
+the same game. That makes a real session usable as a benchmark.
+
+To record, set `_record` in srv6.py to a filename. To replay (from the folder
+containing `map.txt` and `missions.toml`):
+    python archived/srv6_replay.py session.log
+
+>>> import tempfile
+>>> with tempfile.NamedTemporaryFile(suffix=".log", delete=False) as f:
+...     logfile = f.name
+>>> rec = Recorder(logfile)
+>>> rec.record(CliEvent("abc", '{"eventkind": "init", "name": "abc", "avatar": ""}'))
+>>> rec.end_tick()
+>>> rec.record(CliEvent("abc", b"\\x01d"))
+>>> rec.end_tick()
+>>> rec.end_tick()
+>>> rec.close()
+>>> list(read_log(logfile))
+[(0, CliEvent(cid='abc', payload_raw='{"eventkind": "init", ...}')), (1, CliEvent(cid='abc', payload_raw=b'\\x01d')), (3, None)]
+
+The player walks right for 2 ticks:
+>>> gs = GameState(create_entities=False)
+>>> result = replay(logfile, gs)
+>>> result["ticks"], gs.snapshot()["players"]["abc"]["x"]
+(3, 600)
+>>> sorted(result["phases_ms"])
+['apply_inputs', 'encode', 'queue', 'snapshot', 'step']
+>>> os.remove(logfile)
+"""
+import argparse
+import json
+import os
+import statistics
+import struct
+import time
+from typing import Iterator
+
+from srv6_helper import GameState, CliEvent, Disconnect, TickFrames, BadPayload
+
+
+_RECORD = struct.Struct("<IBBI")
+"""tick, kind, client id length, payload length. Followed by the client id and payload."""
+_DISCONNECT, _TEXT, _BYTES, _END = range(4)
+
+
+class Recorder:
+    """Appends client events to `filename`, overwriting whatever was there."""
+    def __init__(self, filename: str):
+        self.__f = open(filename, "wb")
+        self.tick = 0
+        """ticks so far"""
+
+    def record(self, ev: "CliEvent | Disconnect"):
+        cid = ev.cid.encode()
+        if type(ev) == Disconnect:
+            kind, payload = _DISCONNECT, b""
+        elif type(ev.payload_raw) == bytes:
+            kind, payload = _BYTES, ev.payload_raw
+        else:
+            kind, payload = _TEXT, ev.payload_raw.encode()  # type: ignore
+        self.__f.write(_RECORD.pack(self.tick, kind, len(cid), len(payload)) + cid + payload)
+
+    def end_tick(self):
+        self.tick += 1
+        self.__f.flush()
+
+    def close(self):
+        """Mark how many ticks there were, so replays include trailing ticks with no events."""
+        self.__f.write(_RECORD.pack(self.tick, _END, 0, 0))
+        self.__f.close()
+
+
+def read_log(filename: str) -> "Iterator[tuple[int, CliEvent | Disconnect | None]]":
+    """`(tick, event)` for each recorded event. The last one is `(ticks, None)` if
+    the recording was closed properly."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + _RECORD.size <= len(data):
+        tick, kind, cidlen, paylen = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        cid = data[pos:pos + cidlen].decode()
+        payload = data[pos + cidlen:pos + cidlen + paylen]
+        pos += cidlen + paylen
+        if kind == _DISCONNECT:
+            yield tick, Disconnect(cid)
+        elif kind == _TEXT:
+            yield tick, CliEvent(cid, payload.decode())
+        elif kind == _BYTES:
+            yield tick, CliEvent(cid, payload)
+        else:
+            yield tick, None
+
+
+def replay(filename: str, gs: GameState) -> dict:
+    """Feed the events in `filename` to `gs`, ticking in between as fast as possible.
+    Returns ticks/sec and the time spent in each phase of a tick."""
+    events: "dict[int, list[CliEvent | Disconnect]]" = {}
+    ticks = 0
+    for tick, ev in read_log(filename):
+        if ev is None:
+            ticks = max(ticks, tick)
+        else:
+            events.setdefault(tick, []).append(ev)
+            ticks = max(ticks, tick + 1)
+    frames = TickFrames()
+    phases: "dict[str, list[float]]" = {"queue": [], "apply_inputs": [], "step": [], "snapshot": [], "encode": []}
+    rejected = 0
+    start = time.perf_counter()
+    for tick in range(ticks):
+        t0 = time.perf_counter()
+        for ev in events.get(tick, []):
+            try:
+                gs.process_cli_msg(ev)
+            except BadPayload:
+                rejected += 1
+        t1 = time.perf_counter()
+        gs.apply_inputs()
+        t2 = time.perf_counter()
+        gs.step()
+        t3 = time.perf_counter()
+        snap = gs.snapshot()
+        t4 = time.perf_counter()
+        frames.push(snap)
+        frames.for_client(frames.seq - 1)
+        t5 = time.perf_counter()
+        for name, secs in zip(phases, [t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4]):
+            phases[name].append(secs)
+    elapsed = time.perf_counter() - start
+
+    def summary(samples: "list[float]"):
+        if not samples:
+            return {"mean": 0.0, "p95": 0.0, "max": 0.0}
+        samples = sorted(samples)
+        return {
+            "mean": round(statistics.fmean(samples) * 1000, 4),
+            "p95": round(samples[int(0.95 * (len(samples) - 1))] * 1000, 4),
+            "max": round(samples[-1] * 1000, 4),
+        }
+
+    return {
+        "ticks": ticks,
+        "events": sum(map(len, events.values())),
+        "rejected": rejected,
+        "seconds": round(elapsed, 3),
+        "ticks_per_sec": round(ticks / elapsed, 1) if elapsed else None,
+        "phases_ms": {name: summary(samples) for name, samples in phases.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded session as fast as possible and report timings.")
+    parser.add_argument("logfile")
+    parser.add_argument("--map", default="map.txt")
+    parser.add_argument("--missions", default="missions.toml")
+    parser.add_argument("--json", action="store_true", help="print the full result as JSON")
+    args = parser.parse_args()
+
+    result = replay(args.logfile, GameState(mapfile=args.map, missionsfile=args.missions))
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{result['ticks']} ticks, {result['events']} events ({result['rejected']} rejected), "
+          f"{result['ticks_per_sec']} ticks/sec")
+    print(f"{'phase':>13} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, s in result["phases_ms"].items():
+        print(f"{name:>13} {s['mean']:>9} {s['p95']:>9} {s['max']:>9}")
+
+
+if __name__ == "__main__":
+    main()
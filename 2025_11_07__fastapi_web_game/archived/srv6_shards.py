@@ -0,0 +1,215 @@
+"""
+Splitting the world across worker processes, so one game isn't limited to one CPU core.
+
+The world is cut into vertical stripes (by x coordinate), and each stripe is
+owned by a worker process running its own `GameState`. `ShardedGameState` lives
+in the server process and has the same interface `_ConnMgr` uses on a `GameState`,
+so the websocket side doesn't change: it routes each client's events to the shard
+that owns that client's player, ticks every shard in parallel and merges the results.
+
+When a player walks out of its stripe, the shard hands the `Player` back,
+and it's given to the shard that owns its new position on the next tick.
+
+>>> sgs = ShardedGameState(2, mapfile=None, bounds=(0, 1000))
+>>> sgs.stripes
+[(0, 500), (500, 1000)]
+
+A player spawns at (500, 500), which belongs to the second shard:
+>>> sgs.process_cli_msg(CliEvent("abc", '{"eventkind": "init", "name": "abc", "avatar": "/assets/somefile.png"}'))
+>>> sgs.shard_of_player("abc")
+1
+
+Walking left crosses into the first shard:
+>>> sgs.process_cli_msg(CliEvent("abc", '{"eventkind": "keydown", "key": "a"}'))
+>>> sgs.tick()["players"]["abc"]["x"]
+450
+>>> sgs.shard_of_player("abc")
+0
+>>> sgs.tick()["players"]["abc"]["x"]
+400
+>>> sgs.close()
+
+To run the load test (from the folder containing `map.txt`):
+    python archived/srv6_shards.py
+"""
+import asyncio
+import multiprocessing
+import random
+import time
+from multiprocessing.connection import Connection
+
+from srv6_helper import GameState, CliEvent, Disconnect, InitEv, Player, StaticLayer, is_chunked_map, loadmap
+
+
+def _shard_main(conn: Connection, mapfile: "str | None", missionsfile: str, region: "tuple[int, int]"):
+    """Worker process loop. Each tick, receives `(adopted_players, events)` and replies
+    with `(snapshot, leaving_players)`. Receives None when it's time to stop."""
+    gs = GameState(create_entities=mapfile is not None, mapfile=mapfile or "", missionsfile=missionsfile, region=region)
+    x0, x1 = region
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            return
+        adopted, events = msg
+        for cid, p in adopted.items():
+            gs.add_player(cid, p)
+        for ev in events:
+            try:
+                gs.process_cli_msg(ev)
+            except Exception as e:
+                # One bad event shouldn't take the whole stripe down.
+                print("E: shard", region, "failed on", ev, e)
+        snap = gs.tick()
+        snap["dynamic"] = {k: d for k, d in snap["dynamic"].items() if x0 <= d["x"] < x1}
+        leaving = {cid: gs.pop_player(cid) for cid in gs.players_outside(x0, x1)}
+        conn.send((snap, leaving))
+
+
+class ShardedGameState:
+    """A `GameState` split across `nshards` worker processes. Examples in module docstring/doctests."""
+    def __init__(self, nshards: int, mapfile: "str | None" = "map.txt", missionsfile = "missions.toml",
+                 bounds: "tuple[int, int] | None" = None, spawns: "list[tuple[int, int]] | None" = None):
+        """- `bounds`: (min x, max x) of the world to split. By default, taken from the map.
+        - `mapfile = None` gives an empty world, which can be useful for doctests.
+          Chunked maps (see `write_chunked_map`) aren't supported.
+        - `spawns`: where new players appear, in turn. Defaults to (500, 500)."""
+        if mapfile is not None and is_chunked_map(mapfile):
+            raise ValueError("Sharding needs a text map, not a chunked one")
+        static = loadmap(mapfile)[0] if mapfile is not None else {}
+        self.__static_layer = StaticLayer.encode(static)
+        if bounds is None:
+            xs = [e.x for e in static.values()] or [0, 950]
+            bounds = (min(xs), max(xs) + 50)
+        lo, hi = bounds
+        width = -(-(hi - lo) // nshards // 50) * 50
+        self.stripes = [(lo + i * width, lo + (i + 1) * width) for i in range(nshards)]
+        self.__spawns = list(spawns or [(500, 500)])
+        self.__conns: "list[Connection]" = []
+        self.__procs: "list[multiprocessing.Process]" = []
+        for region in self.stripes:
+            ours, theirs = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_shard_main, args=(theirs, mapfile, missionsfile, region), daemon=True)
+            proc.start()
+            self.__conns.append(ours)
+            self.__procs.append(proc)
+        self.__route: "dict[str, int]" = {}
+        """client id -> index of the shard that owns its player"""
+        self.__events: "list[list[CliEvent | Disconnect]]" = [[] for _ in self.stripes]
+        self.__adopt: "list[dict[str, Player]]" = [{} for _ in self.stripes]
+
+    def shard_of(self, x: int) -> int:
+        """Index of the stripe containing `x`. Anything off the edges belongs to the nearest stripe."""
+        for i, (_x0, x1) in enumerate(self.stripes):
+            if x < x1:
+                return i
+        return len(self.stripes) - 1
+
+    def shard_of_player(self, cid: str) -> "int | None":
+        return self.__route.get(cid)
+
+    def static_layer(self) -> StaticLayer:
+        return self.__static_layer
+
+    def static_chunk_layer(self, cx: int, cy: int) -> None:
+        """Always None: the map isn't chunked."""
+        return None
+
+    def get_static(self):
+        return self.__static_layer.json
+
+    def process_cli_msg(self, ce: 'CliEvent | Disconnect'):
+        """Queue `ce` for the shard that owns the client's player. A client's first event
+        should be an InitEv; its player is created here and sent to the right shard."""
+        if ce.cid not in self.__route:
+            if type(ce) == Disconnect:
+                return
+            paylo = ce.get_payload()
+            if type(paylo) != InitEv:
+                print("W: ignoring event from", ce.cid, "before init:", paylo)
+                return
+            x, y = self.__spawns[0]
+            self.__spawns.append(self.__spawns.pop(0))
+            shard = self.shard_of(x)
+            self.__route[ce.cid] = shard
+            self.__adopt[shard][ce.cid] = Player(x, y, paylo.name, paylo.avatar)
+            return
+        shard = self.__route[ce.cid]
+        self.__events[shard].append(ce)
+        if type(ce) == Disconnect:
+            del self.__route[ce.cid]
+
+    def tick(self):
+        """Tick every shard in parallel, hand over players that changed stripes,
+        and return the merged snapshot."""
+        for i, conn in enumerate(self.__conns):
+            conn.send((self.__adopt[i], self.__events[i]))
+        self.__events = [[] for _ in self.stripes]
+        self.__adopt = [{} for _ in self.stripes]
+        merged = {"dynamic": {}, "players": {}}
+        for conn in self.__conns:
+            snap, leaving = conn.recv()
+            merged["dynamic"].update(snap["dynamic"])
+            merged["players"].update(snap["players"])
+            for cid, p in leaving.items():
+                if cid not in self.__route:
+                    continue  # disconnected while in transit
+                shard = self.shard_of(p.x)
+                self.__route[cid] = shard
+                self.__adopt[shard][cid] = p
+        return merged
+
+    def close(self):
+        for conn in self.__conns:
+            conn.send(None)
+        for proc in self.__procs:
+            proc.join()
+
+
+def _write_open_map(width: int, height: int) -> str:
+    """An empty map with a wall border, in a temp file. Returns the filename."""
+    import tempfile
+    rows = ["w" * width] + ["w" + " " * (width - 2) + "w" for _ in range(height - 2)] + ["w" * width]
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        f.write("\n".join(rows))
+    return f.name
+
+
+def loadtest(nclients: int, nshards: int, seconds = 5.0, fps = 30):
+    """Run `nclients` bots against a `_ConnMgr` with `nshards` shards (0 means a plain
+    `GameState`) on a large open map, and return the tick stats."""
+    from srv6 import _ConnMgr, _TickStats, _fixed_rate_loop
+    from srv_loadgen import BotSocket
+    import os
+    width = 800
+    mapfile = _write_open_map(width, 60)
+    # spread the players over the whole map, so every shard has some
+    spawns = [(x, 500) for x in range(0, (width - 20) * 50, 250)]
+    cm = _ConnMgr(shards=nshards, mapfile=mapfile, spawns=spawns)
+    stats = _TickStats(fps)
+
+    async def main():
+        stop = asyncio.Event()
+        rng = random.Random(nclients)
+        bots = [BotSocket(rng, 4, stop) for _ in range(nclients)]
+        clients = [asyncio.create_task(cm.websocket_endpoint_impl(b.send_text, b.receive_text)) for b in bots]
+        await _fixed_rate_loop(cm.trigger_tick, fps, stats, max_ticks=int(seconds * fps))
+        stop.set()
+        await asyncio.gather(*clients)
+
+    start = time.perf_counter()
+    try:
+        asyncio.run(main())
+    finally:
+        cm.close()
+        os.remove(mapfile)
+    result = stats.todict()
+    result["wall_seconds"] = round(time.perf_counter() - start, 2)
+    return result
+
+
+if __name__ == "__main__":
+    print(f"{'clients':>8} {'shards':>7} {'hz':>6} {'mean ms':>8} {'overruns':>9}")
+    for nclients in [100, 500, 2000]:
+        for nshards in [0, 1, 2, 4, 8]:
+            r = loadtest(nclients, nshards)
+            print(f"{nclients:>8} {nshards:>7} {r['achieved_hz']:>6} {r['mean_ms']:>8} {r['overruns']:>9}")
@@ -0,0 +1,177 @@
+"""
+Headless load generator for the websocket game servers.
+
+Scripted bots stand in for browsers: each one is a `BotSocket`, which looks enough
+like a starlette `WebSocket` to be passed straight to a server module's
+`websocket_endpoint`. That works for every server version here, because they all
+read with `receive_text` and write with `send_text`/`send_json` (srv6 reads with
+`receive` instead, and also uses `send_bytes` and `query_params`). For servers with a `_lifespan`, such as srv6,
+the game loop is started too.
+
+To run (from the folder containing `map.txt` and `missions.toml`):
+    python archived/srv_loadgen.py srv6 --players 10 50 100 --seconds 5 --out srv6.json
+
+Each step of the ramp reports:
+- `ticks`: the server's own tick stats, if it keeps any (srv6's `_tickstats`)
+- `input_latency_ms`: time from a bot sending a key event until the server next sends
+  that bot anything. On a tick-based server, that's the input-to-broadcast latency.
+- `cpu_percent`: CPU time of this process (server and bots) per wall-clock second
+- `bytes_per_sec`, `messages_per_sec`: everything the server sent, summed over all bots
+
+Bots send srv5/srv6-style `init`, `keydown` and `keyup` events. Servers that expect
+different messages (srv2's "move", srv5's shape/color init) need `--init` to match.
+srv5 imports its helper as `archived.srv5_helper`, so it's run as:
+    PYTHONPATH=. python archived/srv_loadgen.py archived.srv5 --init '{"eventkind": "init", "name": "bot", "shape": "circle", "color": "red"}'
+
+>>> async def demo():
+...     stop = asyncio.Event()
+...     bot = BotSocket(random.Random(0), rate=100, stop=stop)
+...     first = await bot.receive_text()
+...     second = await bot.receive_text()
+...     await bot.send_text("tick")
+...     return first, second, bot.messages, len(bot.latencies)
+>>> asyncio.run(demo())
+('{"eventkind": "init", ...}', '{"eventkind": "key...", "key": "..."}', 1, 1)
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import random
+import statistics
+import time
+
+from fastapi import WebSocketDisconnect
+
+
+SRV6_INIT = '{"eventkind": "init", "name": "bot", "avatar": "/assets/robot_idle.png"}'
+
+
+class BotSocket:
+    """A fake websocket driven by a bot. Whenever the server reads, it gets the bot's
+    next event, about `rate` per second, until `stop` is set. Everything the server
+    sends is counted."""
+    def __init__(self, rng: random.Random, rate: float, stop: asyncio.Event,
+                 init_payload = SRV6_INIT, query_params: "dict[str, str] | None" = None):
+        self.query_params = query_params or {}
+        self.bytes_received = 0
+        self.messages = 0
+        self.latencies: "list[float]" = []
+        """seconds from sending a key event until the server sent this bot something"""
+        self.__rng = rng
+        self.__rate = rate
+        self.__stop = stop
+        self.__init_payload: "str | None" = init_payload
+        self.__input_sent_at: "float | None" = None
+
+    async def accept(self):
+        pass
+
+    def __received(self, nbytes: int):
+        self.bytes_received += nbytes
+        self.messages += 1
+        if self.__input_sent_at is not None:
+            self.latencies.append(time.perf_counter() - self.__input_sent_at)
+            self.__input_sent_at = None
+
+    async def send_text(self, x: str):
+        self.__received(len(x.encode()))
+
+    async def send_bytes(self, x: bytes):
+        self.__received(len(x))
+
+    async def send_json(self, x):
+        self.__received(len(json.dumps(x).encode()))
+
+    async def receive_text(self) -> str:
+        if self.__init_payload is not None:
+            payload, self.__init_payload = self.__init_payload, None
+            return payload
+        await asyncio.sleep(self.__rng.expovariate(self.__rate))
+        if self.__stop.is_set():
+            raise WebSocketDisconnect()
+        if self.__input_sent_at is None:
+            self.__input_sent_at = time.perf_counter()
+        return json.dumps({"eventkind": self.__rng.choice(["keydown", "keyup"]), "key": self.__rng.choice("wasd")})
+
+    async def receive(self) -> dict:
+        """Like `receive_text`, as an ASGI message"""
+        try:
+            return {"type": "websocket.receive", "text": await self.receive_text()}
+        except WebSocketDisconnect:
+            return {"type": "websocket.disconnect", "code": 1000}
+
+
+def _percentiles_ms(samples: "list[float]"):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    def pct(p):
+        return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000, 3)
+    return {"p50": pct(50), "p95": pct(95), "p99": pct(99), "max": round(samples[-1] * 1000, 3),
+            "mean": round(statistics.fmean(samples) * 1000, 3)}
+
+
+def run_step(server, nplayers: int, seconds: float, rate: float, init_payload = SRV6_INIT):
+    """Connect `nplayers` bots to the `server` module for `seconds`, and return the measurements."""
+    if hasattr(server, "_tickstats"):
+        server._tickstats = server._TickStats(server._fps)
+
+    async def main():
+        stop = asyncio.Event()
+        rng = random.Random(nplayers)
+        bots = [BotSocket(rng, rate, stop, init_payload) for _ in range(nplayers)]
+
+        async def run_bots():
+            tasks = [asyncio.create_task(server.websocket_endpoint(b)) for b in bots]
+            await asyncio.sleep(seconds)
+            stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if hasattr(server, "_lifespan"):
+            async with server._lifespan(server.app):
+                await run_bots()
+        else:
+            await run_bots()
+        return bots
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    bots = asyncio.run(main())
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    return {
+        "players": nplayers,
+        "seconds": round(wall, 3),
+        "ticks": server._tickstats.todict() if hasattr(server, "_tickstats") else None,
+        "input_latency_ms": _percentiles_ms([lat for b in bots for lat in b.latencies]),
+        "cpu_percent": round(cpu / wall * 100, 1),
+        "bytes_per_sec": round(sum(b.bytes_received for b in bots) / wall),
+        "messages_per_sec": round(sum(b.messages for b in bots) / wall),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp up bots against a server module and write the results as JSON.")
+    parser.add_argument("server", help="module name, e.g. srv6")
+    parser.add_argument("--players", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--seconds", type=float, default=5.0, help="per step")
+    parser.add_argument("--rate", type=float, default=4.0, help="key events per second per bot")
+    parser.add_argument("--init", default=SRV6_INIT, help="the first message each bot sends")
+    parser.add_argument("--out", help="JSON file to write (default: print)")
+    args = parser.parse_args()
+
+    server = importlib.import_module(args.server)
+    steps = []
+    for n in args.players:
+        step = run_step(server, n, args.seconds, args.rate, args.init)
+        print(f"players={n} cpu={step['cpu_percent']}% bytes/s={step['bytes_per_sec']} latency={step['input_latency_ms']}")
+        steps.append(step)
+    result = {"server": args.server, "rate": args.rate, "steps": steps}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
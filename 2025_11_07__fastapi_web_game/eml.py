@@ -3,6 +3,7 @@ from dataclasses import dataclass, field
 import html
 import inspect
 import json
+import time
 from typing import Any, Callable, TYPE_CHECKING, Literal
 from types import SimpleNamespace as Sns  # type: ignore
 
@@ -148,6 +149,377 @@ class Mission:
     objectives: "list[Objective]"
 
 
+class Occupancy:
+    """How many impassable entities are on each map tile, so checking whether the player
+    can move somewhere doesn't look at any entities. Built by `load_map`, and kept up to date
+    as dynamic entities move or go away (see `move_dynamic` and `remove_dynamic`).
+    >>> occ = Occupancy(-10, -10, 30, 20)
+    >>> occ.block(0, 50)
+    >>> occ.passable(0, 50), occ.passable(50, 50)
+    (False, True)
+
+    A 50x50 box that isn't lined up with the tiles overlaps up to 4 of them:
+    >>> occ.box_passable(25, 25), occ.box_passable(25, 100), occ.box_passable(50, 25)
+    (False, True, True)
+
+    An entity's box blocks every tile it overlaps, and unblocking only frees
+    tiles that nothing else is on:
+    >>> occ.block_box(25, 50)
+    >>> occ.passable(50, 50), occ.passable(100, 50)
+    (False, True)
+    >>> occ.unblock_box(25, 50)
+    >>> occ.passable(0, 50), occ.passable(50, 50)
+    (False, True)
+    """
+    def __init__(self, col0: int, row0: int, width: int, height: int, tile = 50):
+        """Covers `width` x `height` tiles, with the top-left tile at (col0 * tile, row0 * tile)."""
+        self.col0, self.row0 = col0, row0
+        self.width, self.height = width, height
+        self.tile = tile
+        self.counts = bytearray(width * height)
+
+    def index(self, x: int, y: int) -> "int | None":
+        """Bit number of the tile containing (x, y), or None if that's off the map."""
+        col = x // self.tile - self.col0
+        row = y // self.tile - self.row0
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return row * self.width + col
+        return None
+
+    def block(self, x: int, y: int):
+        i = self.index(x, y)
+        if i is None:
+            raise IndexError(f"({x}, {y}) is off the map")
+        self.counts[i] += 1
+
+    def unblock(self, x: int, y: int):
+        i = self.index(x, y)
+        if i is None:
+            raise IndexError(f"({x}, {y}) is off the map")
+        self.counts[i] -= 1
+
+    def passable(self, x: int, y: int) -> bool:
+        i = self.index(x, y)
+        return i is None or not self.counts[i]
+
+    def box_tiles(self, x: int, y: int) -> "list[tuple[int, int]]":
+        """Corners of the on-map tiles that a tile-sized box with its corner at (x, y) overlaps."""
+        t = self.tile
+        return [
+            (tx, ty)
+            for ty in range(y // t * t, y + t, t)
+            for tx in range(x // t * t, x + t, t)
+            if self.index(tx, ty) is not None
+        ]
+
+    def box_passable(self, x: int, y: int) -> bool:
+        """Whether a tile-sized box with its corner at (x, y) overlaps no blocked tile."""
+        return all(self.passable(tx, ty) for tx, ty in self.box_tiles(x, y))
+
+    def block_box(self, x: int, y: int):
+        for tx, ty in self.box_tiles(x, y):
+            self.block(tx, ty)
+
+    def unblock_box(self, x: int, y: int):
+        for tx, ty in self.box_tiles(x, y):
+            self.unblock(tx, ty)
+
+
+class EntityGrid:
+    """Entities bucketed by `cell`-px squares, so that finding the ones in a rectangle
+    (such as the part of the map on screen) doesn't look at the rest. Built once by `load_map`.
+    >>> grid = EntityGrid()
+    >>> grid.add(Entity(0, 0, "", "", False))
+    >>> grid.add(Entity(2000, 0, "", "", False))
+    >>> [e.x for e in grid.query(-500, -500, 500, 500)]
+    [0]
+    """
+    def __init__(self, cell = 500):
+        self.cell = cell
+        self.cells: "dict[tuple[int, int], list[Entity]]" = {}
+
+    def add(self, e: Entity):
+        self.cells.setdefault((e.x // self.cell, e.y // self.cell), []).append(e)
+
+    def remove(self, e: Entity):
+        """Remove `e`, which must still be where it was when it was added."""
+        key = (e.x // self.cell, e.y // self.cell)
+        self.cells[key].remove(e)
+        if not self.cells[key]:
+            del self.cells[key]
+
+    def query(self, x0: int, y0: int, x1: int, y1: int) -> "list[Entity]":
+        """Entities with x0 <= x < x1 and y0 <= y < y1, in the order they were added within each cell."""
+        c = self.cell
+        found = []
+        for cy in range(y0 // c, (y1 - 1) // c + 1):
+            for cx in range(x0 // c, (x1 - 1) // c + 1):
+                for e in self.cells.get((cx, cy), ()):
+                    if x0 <= e.x < x1 and y0 <= e.y < y1:
+                        found.append(e)
+        return found
+
+
+class StaticChunks:
+    """The static entities, drawn once into `size`-px square offscreen canvases ("chunks"),
+    so a frame draws the few chunks on screen instead of every wall and tree.
+
+    Chunk (cx, cy) has the entities with `cx * size <= x < (cx + 1) * size` (likewise for y).
+    Entities are drawn 25 px either side of their position, so its canvas starts at
+    (cx * size - 25, cy * size - 25), and no entity is split between chunks.
+    >>> chunks = StaticChunks({"a": Entity(0, 0, "", "", False), "b": Entity(2000, 0, "", "", False)})
+    >>> chunks.visible(-500, -500, 1000, 1000)
+    [(0, 0)]
+
+    However many entities there are, a 1000 x 1000 px screen shows at most 9 chunks:
+    >>> static, dynamic, blocked, grid = asyncio.run(load_map("map.txt"))
+    >>> chunks = StaticChunks(static)
+    >>> len(static) > 5000, len(chunks.visible(0, 0, 1000, 1000)) <= 9
+    (True, True)
+    """
+    def __init__(self, static: "dict[str, Entity]", size = 500):
+        self.size = size
+        self.grid = EntityGrid(size)
+        for e in static.values():
+            self.grid.add(e)
+        self.__canvases: "dict[tuple[int, int], Any]" = {}
+        self.__images_loaded = -1
+        self.revision = 0
+        """changes whenever entities are added or removed (see `frame_key`)"""
+
+    def add(self, entities: "list[Entity]"):
+        """Add static entities, e.g. as a `MapStream` loads them."""
+        for e in entities:
+            self.grid.add(e)
+            self.__canvases.pop((e.x // self.size, e.y // self.size), None)
+        self.revision += 1
+
+    def remove(self, entities: "list[Entity]"):
+        for e in entities:
+            self.grid.remove(e)
+            self.__canvases.pop((e.x // self.size, e.y // self.size), None)
+        self.revision += 1
+
+    def visible(self, left: int, top: int, width: int, height: int) -> "list[tuple[int, int]]":
+        """Non-empty chunks overlapping the `width` x `height` rectangle at (left, top)"""
+        s = self.size
+        return [
+            (cx, cy)
+            for cy in range((top + 25) // s, (top + height + 24) // s + 1)
+            for cx in range((left + 25) // s, (left + width + 24) // s + 1)
+            if (cx, cy) in self.grid.cells
+        ]
+
+    def draw(self, ctx: "CanvasRenderingContext", left: int, top: int, width: int, height: int) -> int:
+        """Draw the chunks on screen, with the screen's top-left at (left, top) in the world.
+        Returns how many there were."""
+        if self.__images_loaded != G.images_loaded:
+            # Chunks drawn while images were still loading are missing them
+            self.__canvases.clear()
+            self.__images_loaded = G.images_loaded
+        s = self.size
+        visible = self.visible(left, top, width, height)
+        for cx, cy in visible:
+            canvas = self.__canvases.get((cx, cy))
+            if canvas is None:
+                canvas = self.__canvases[cx, cy] = self.__render(cx, cy)
+            ctx.drawImage(canvas, cx * s - 25 - left, cy * s - 25 - top)
+        return len(visible)
+
+    def __render(self, cx: int, cy: int):
+        canvas = new_canvas(self.size, self.size)
+        chunk_ctx = CountingContext(canvas.getContext("2d"))
+        for e in self.grid.cells[cx, cy]:
+            chunk_ctx.drawImage(make_image(e), e.x - cx * self.size, e.y - cy * self.size, 50, 50)
+        return canvas
+
+
+class CountingContext:
+    """Wraps a canvas context, counting method calls and property sets: each one is a
+    call from Python into JS, which is what makes drawing from Pyodide slow.
+    The count is shared by all contexts, and reset by whoever is measuring.
+    >>> ctx = CountingContext(Sns(fillRect=lambda *args: None))
+    >>> CountingContext.calls = 0
+    >>> ctx.fillStyle = "red"
+    >>> ctx.fillRect(0, 0, 10, 10)
+    >>> CountingContext.calls, ctx.fillStyle
+    (2, 'red')
+    """
+    calls = 0
+
+    def __init__(self, ctx: "CanvasRenderingContext"):
+        object.__setattr__(self, "_ctx", ctx)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._ctx, name)
+        if not callable(attr):
+            return attr
+        def counted(*args):
+            CountingContext.calls += 1
+            return attr(*args)
+        return counted
+
+    def __setattr__(self, name: str, value):
+        CountingContext.calls += 1
+        setattr(self._ctx, name, value)
+
+
+class MapStream:
+    """A map written by `write_chunked_map` (in archived/srv6_helper.py), read a chunk at a time
+    so that large worlds start as fast as small ones. `follow` loads the chunks within `radius`
+    of the player in the background, and once more than `capacity` are loaded, drops those
+    used least recently. Their static entities are added to and removed from `chunks`.
+
+    Stands in for an `Occupancy` (for `is_passable` etc.). Tiles in chunks that
+    aren't loaded yet are impassable.
+    >>> import os, tempfile
+    >>> body = b"  w\\nt"  # chunk (0, 0) of 4 x 4 tiles: a wall at tile (2, 0), and a tree at (0, 1)
+    >>> header = json.dumps({"chunk": 4, "index": {"0,0": [0, len(body)]}, "dynamic": [["c", 5, 0]]}).encode()
+    >>> with tempfile.NamedTemporaryFile("wb", suffix=".chunks", delete=False) as f:
+    ...     _ = f.write(b"CHUNKMAP %d\\n" % len(header) + header + body)
+    >>> static, dynamic, stream, grid = asyncio.run(load_map(f.name))
+    >>> static, list(dynamic), stream.passable(0, 0), stream.passable(500, 0)
+    ({}, ['coin5,0'], False, True)
+    >>> async def walk(x, y):
+    ...     await asyncio.gather(*stream.follow(x, y))
+    >>> asyncio.run(walk(0, 0))
+    >>> stream.loaded(), stream.passable(0, 0), stream.passable(100, 0), stream.box_passable(25, 25)
+    ([(0, 0)], True, False, False)
+    >>> sorted(e.avatar for e in stream.chunks.grid.query(0, 0, 200, 200))
+    ['/assets/brick2.png', '/assets/tree.png']
+
+    Once more than `capacity` chunks are loaded, ones far enough away go:
+    >>> stream.capacity = 0
+    >>> asyncio.run(walk(1000, 0))
+    >>> stream.loaded(), stream.chunks.grid.query(0, 0, 200, 200), stream.passable(100, 0)
+    ([], [], False)
+
+    A chunk that fails to load stays impassable, and is tried again by the next `follow`:
+    >>> with open(f.name, "ab") as f2:
+    ...     _ = f2.write(b"\\xff")
+    >>> stream.index[(0, 1)] = [len(body), 1]
+    >>> asyncio.run(walk(0, 0))  # doctest: +ELLIPSIS
+    Failed to load chunk (0, 1): 'utf-8' codec can't decode byte 0xff ...
+    >>> stream.loaded(), stream.passable(0, 200)
+    ([(0, 0)], False)
+    >>> stream.index[(0, 1)] = [0, 0]
+    >>> asyncio.run(walk(0, 0))
+    >>> stream.loaded(), stream.passable(0, 200)
+    ([(0, 0), (0, 1)], True)
+    >>> os.remove(f.name)
+    """
+    def __init__(self, filename: str, header: dict, bodies_start: int, radius = 1, capacity = 16):
+        self.filename = filename
+        self.size = header["chunk"]
+        """in tiles"""
+        self.px = self.size * 50
+        self.dynamic: "list[list]" = header["dynamic"]
+        """`[char, xidx, yidx]` of each dynamic entity"""
+        self.index: "dict[tuple[int, int], list[int]]" = {
+            tuple(map(int, key.split(","))): span for key, span in header["index"].items()  # type: ignore
+        }
+        self.radius = radius
+        self.capacity = capacity
+        self.chunks = StaticChunks({})
+        self.__bodies_start = bodies_start
+        self.__loaded: "dict[tuple[int, int], tuple[list[Entity], Occupancy]]" = {}
+        """least recently wanted first (dicts keep insertion order)"""
+        self.__pending: "dict[tuple[int, int], asyncio.Task]" = {}
+        self.__wanted: "list[tuple[int, int]]" = []
+        """chunks within `radius` of the player"""
+        self.__dynamic_blocked: "dict[tuple[int, int], int]" = {}
+        """tile corner -> how many impassable dynamic entities are on it"""
+
+    @staticmethod
+    async def open(filename: str) -> "MapStream | None":
+        """Reads the header, or returns None if `filename` isn't a chunked map."""
+        start = await read_range(filename, 0, 32)
+        if not start.startswith(b"CHUNKMAP "):
+            return None
+        newline = start.index(b"\n")
+        length = int(start[len(b"CHUNKMAP "):newline])
+        header = json.loads(await read_range(filename, newline + 1, length))
+        return MapStream(filename, header, newline + 1 + length)
+
+    def loaded(self) -> "list[tuple[int, int]]":
+        return list(self.__loaded)
+
+    def follow(self, x: int, y: int) -> "list[asyncio.Task]":
+        """Start loading the chunks around (x, y) that aren't loaded, and drop far ones.
+        Returns the loads in progress."""
+        cx, cy = x // self.px, y // self.px
+        r = self.radius
+        self.__wanted = [(cx + dx, cy + dy) for dy in range(-r, r + 1) for dx in range(-r, r + 1)]
+        for key in self.__wanted:
+            if key in self.__loaded:
+                self.__loaded[key] = self.__loaded.pop(key)
+            elif key in self.index and key not in self.__pending:
+                self.__pending[key] = asyncio.create_task(self.__load(key))
+        self.__evict()
+        return list(self.__pending.values())
+
+    def __evict(self):
+        for key in list(self.__loaded):
+            if len(self.__loaded) <= self.capacity or key in self.__wanted:
+                break
+            entities, _blocked = self.__loaded.pop(key)
+            self.chunks.remove(entities)
+
+    async def __load(self, key: "tuple[int, int]"):
+        try:
+            offset, length = self.index[key]
+            text = (await read_range(self.filename, self.__bodies_start + offset, length)).decode()
+        except Exception as e:
+            print(f"Failed to load chunk {key}:", e)
+            return
+        finally:
+            del self.__pending[key]
+        n = self.size
+        cx, cy = key
+        static: "dict[str, Entity]" = {}
+        blocked = Occupancy(cx * n, cy * n, n, n)
+        for yidx, line in enumerate(text.splitlines(), cy * n):
+            for xidx, char in enumerate(line, cx * n):
+                if map_entity(char, xidx, yidx, static, {}):
+                    blocked.block(50*xidx, 50*yidx)
+        self.__loaded[key] = (list(static.values()), blocked)
+        self.chunks.add(list(static.values()))
+        self.__evict()
+
+    def passable(self, x: int, y: int) -> bool:
+        tile = (x // 50 * 50, y // 50 * 50)
+        if self.__dynamic_blocked.get(tile):
+            return False
+        key = (x // self.px, y // self.px)
+        if key not in self.index:
+            return True
+        chunk = self.__loaded.get(key)
+        return chunk is not None and chunk[1].passable(x, y)
+
+    def box_tiles(self, x: int, y: int) -> "list[tuple[int, int]]":
+        """Corners of the tiles that a tile-sized box with its corner at (x, y) overlaps."""
+        return [(tx, ty) for ty in range(y // 50 * 50, y + 50, 50) for tx in range(x // 50 * 50, x + 50, 50)]
+
+    def box_passable(self, x: int, y: int) -> bool:
+        return all(self.passable(tx, ty) for tx, ty in self.box_tiles(x, y))
+
+    def block_box(self, x: int, y: int):
+        for tile in self.box_tiles(x, y):
+            self.__dynamic_blocked[tile] = self.__dynamic_blocked.get(tile, 0) + 1
+
+    def unblock_box(self, x: int, y: int):
+        for tile in self.box_tiles(x, y):
+            self.__dynamic_blocked[tile] -= 1
+            if not self.__dynamic_blocked[tile]:
+                del self.__dynamic_blocked[tile]
+
+
+def new_canvas(width: int, height: int):
+    """A canvas that isn't on the page, to draw into and then onto the real one."""
+    from js import OffscreenCanvas  # type: ignore
+    return OffscreenCanvas.new(width, height)
+
+
 @prex
 def getElementByIdWithErr(elemid: str) -> "HTMLElement":
     """Same as normal `document.getElementById`, but
@@ -185,7 +557,20 @@ try:
         """Global vars. Don't instantiate this class; it's just a grouping"""
         static: "dict[str, Entity]" = {}
         dynamic: "dict[str, Entity]" = {}
+        blocked: "Occupancy | MapStream" = Occupancy(0, 0, 0, 0)
+        """tiles blocked by static and dynamic entities"""
+        grid: "EntityGrid" = EntityGrid()
+        """dynamic entities, by position, for drawing only what's on screen"""
+        chunks: "StaticChunks" = StaticChunks({})
+        """static entities, pre-drawn"""
         img_cache: "dict[str, JSImg]" = {}
+        images_loaded = 0
+        """so that frames drawn while images were loading get drawn again (see `frame_key`)"""
+        last_frame: "tuple | None" = None
+        show_stats = True
+        """overlay the time, canvas calls and entities of each drawn frame (toggled with "p")"""
+        frame_proxy: Any = None
+        """`draw_one_frame` wrapped for `requestAnimationFrame`; kept so it isn't garbage collected"""
         player: "Player"
         current_target: "Entity | None" = None
         all_missions: "list[Mission]"
@@ -198,7 +583,7 @@ try:
         class H:
             """HTML-related globals (divs, canvas, etc)"""
             canvas: "Canvas" = getElementByIdWithErr('canvas')  # type: ignore
-            ctx = canvas.getContext('2d')
+            ctx = CountingContext(canvas.getContext('2d'))
             mission_panel = getElementByIdWithErr("mission-panel")
             npc_img = getElementByIdWithErr("mission-npc-img")
             dialog = getElementByIdWithErr("mission-dialog")
@@ -235,10 +620,14 @@ async def keydown(event):
             await attempt_action()
         else:
             await cancel_mission()
+    elif event.key == "p":
+        G.show_stats = not G.show_stats
     
     if is_passable(new_x, new_y):
         G.player.x, G.player.y = new_x, new_y
         update_player_info()
+        if isinstance(G.blocked, MapStream):
+            G.blocked.follow(new_x, new_y)
     if event.key in ["w", "a", "s", "d"]:
         G.player.facing = event.key # type: ignore
     
@@ -259,26 +648,75 @@ async def startBtnclicked(event=None):
     body.onkeydown = keydown
     body.onkeyup = keyup
     await asyncio.sleep(0.0)  # yields control to browser to render DOM
-    G.static, G.dynamic = await load_map("map.txt")
+    G.static, G.dynamic, G.blocked, G.grid = await load_map("map.txt")
+    if isinstance(G.blocked, MapStream):
+        G.chunks = G.blocked.chunks
+        await asyncio.gather(*G.blocked.follow(G.player.x, G.player.y))
+    else:
+        G.chunks = StaticChunks(G.static)
     
     update_player_info()
-    asyncio.create_task(draw_loop())    
+    start_render_loop()
 
 
 @prex
 def is_passable(new_x: int, new_y: int) -> bool:
-    """Check whether the player can move to (new_x, new_y) based on entities."""
-    all_ents = list(G.static.values()) + list(G.dynamic.values())
-    impas = list(filter(lambda e: not e.passable, all_ents))
-    for entity in impas:
-        if (
-            new_x < entity.x + 50 and
-            new_x + 50 > entity.x and
-            new_y < entity.y + 50 and
-            new_y + 50 > entity.y
-        ):
-                return False
-    return True
+    """Check whether the player can move to (new_x, new_y) based on entities,
+    by looking up the tiles it would be on in `G.blocked`.
+
+    On `map.txt`, that agrees with checking the player's box against every impassable entity's:
+    >>> import random
+    >>> static, dynamic, blocked, grid = asyncio.run(load_map("map.txt"))
+    >>> boxes = [(e.x, e.y) for e in [*static.values(), *dynamic.values()] if not e.passable]
+    >>> def overlaps_any(x, y):
+    ...     return any(x < ex + 50 and x + 50 > ex and y < ey + 50 and y + 50 > ey for ex, ey in boxes)
+    >>> rng = random.Random(0)
+    >>> spots = [(x, y) for x in range(0, 1001, 25) for y in range(0, 1001, 25)]
+    >>> spots += [(rng.randrange(-600, 6200, 25), rng.randrange(-600, 7000, 25)) for _ in range(300)]
+    >>> spots += [(ex + dx, ey + dy) for ex, ey in boxes[-20:] for dx in (-50, -25, 0, 25) for dy in (-50, 0, 25)]
+    >>> all(blocked.box_passable(x, y) == (not overlaps_any(x, y)) for x, y in spots)
+    True
+    """
+    return G.blocked.box_passable(new_x, new_y)
+
+
+def move_dynamic(entity: Entity, x: int, y: int):
+    """Move a dynamic entity, keeping `G.blocked` and `G.grid` up to date.
+
+    G needs a browser, so stand in for it here:
+
+    >>> import sys
+    >>> module = sys.modules[move_dynamic.__module__]
+    >>> static, dynamic, blocked, grid = asyncio.run(load_map("map.txt"))
+    >>> module.G = Sns(dynamic=dynamic, blocked=blocked, grid=grid, last_frame=None)
+    >>> npc = dynamic["npcr112,15"]
+    >>> npc.passable, is_passable(600, 750), is_passable(500, 550)
+    (False, False, True)
+    >>> move_dynamic(npc, 500, 550)
+    >>> is_passable(600, 750), is_passable(500, 550)
+    (True, False)
+    >>> npc in grid.query(600, 750, 650, 800), npc in grid.query(500, 550, 550, 600)
+    (False, True)
+    >>> remove_dynamic("npcr112,15")
+    >>> is_passable(500, 550), npc in grid.query(500, 550, 550, 600), "npcr112,15" in dynamic
+    (True, False, False)
+    >>> del module.G
+    """
+    G.grid.remove(entity)
+    if not entity.passable:
+        G.blocked.unblock_box(entity.x, entity.y)
+        G.blocked.block_box(x, y)
+    entity.x, entity.y = x, y
+    G.grid.add(entity)
+    G.last_frame = None
+
+
+def remove_dynamic(key: str):
+    """Remove a dynamic entity (e.g. a collected coin), keeping `G.blocked` and `G.grid` up to date."""
+    entity = G.dynamic.pop(key)
+    G.grid.remove(entity)
+    if not entity.passable:
+        G.blocked.unblock_box(entity.x, entity.y)
 
 
 @prex
@@ -366,21 +804,31 @@ def make_image(ep: "Entity | Player") -> "JSImg":
             print(f"ERROR: failed to load image '{source}'")
             raise FileNotFoundError(f"Image not found: {source}")
 
+        def onload(event):
+            G.images_loaded += 1
+
         img.onerror = onerror
+        img.onload = onload
         img.src = source
         G.img_cache[source] = img
     return G.img_cache[source]
 
 
 @prex
-def draw_entities():
-    """Draws all entities from the static dictionary to the canvas."""
-    for entity in list(G.static.values()) + list(G.dynamic.values()):
-        img = make_image(entity)
-        screen_x = entity.x - G.player.x + G.H.canvas.width // 2
-        screen_y = entity.y - G.player.y + G.H.canvas.height // 2
-        G.H.ctx.drawImage(img, screen_x - 25, screen_y - 25, 50, 50)  # center entity image
-        
+def draw_entities(width: int, height: int) -> "tuple[int, int]":
+    """Draws the entities that are on the `width` x `height` canvas: static ones
+    from `G.chunks`, dynamic ones found with `G.grid`.
+    Returns how many chunks and dynamic entities were drawn."""
+    left = G.player.x - width // 2
+    top = G.player.y - height // 2
+    ctx = G.H.ctx
+    chunks = G.chunks.draw(ctx, left, top, width, height)
+    # an entity is drawn 25 px either side of its position
+    entities = G.grid.query(left - 25, top - 25, left + width + 25, top + height + 25)
+    for entity in entities:
+        ctx.drawImage(make_image(entity), entity.x - left - 25, entity.y - top - 25, 50, 50)  # center entity image
+    return chunks, len(entities)
+
 
 @prex
 def draw_player():
@@ -395,13 +843,44 @@ def draw_player():
     G.H.ctx.fillText(G.player.name, cx, cy + 40)
 
 
+def frame_key() -> tuple:
+    """Everything a frame depends on. If it's the same as last frame's, there's nothing to redraw."""
+    p = G.player
+    return (p.x, p.y, p.name, p.avatar, id(G.grid), id(G.chunks), G.chunks.revision, len(G.dynamic),
+            G.images_loaded, G.show_stats)
+
+
 @prex
-def draw_one_frame():
-    """draws bg and runs draw_player() and draw_entities() functions"""
+def draw_one_frame() -> bool:
+    """draws bg and runs draw_player() and draw_entities() functions,
+    unless nothing changed since the last frame. Returns whether it drew."""
+    key = frame_key()
+    if key == G.last_frame:
+        return False
+    G.last_frame = key
+    start = time.perf_counter()
+    CountingContext.calls = 0
+    width, height = G.H.canvas.width, G.H.canvas.height
     G.H.ctx.fillStyle = "#bfb"
-    G.H.ctx.fillRect(0, 0, G.H.canvas.width, G.H.canvas.height)
+    G.H.ctx.fillRect(0, 0, width, height)
     draw_player()
-    draw_entities()
+    chunks, entities = draw_entities(width, height)
+    if G.show_stats:
+        ms = (time.perf_counter() - start) * 1000
+        draw_stats(f"{ms:.1f} ms, {CountingContext.calls} canvas calls, {entities + 1} entities + {chunks} chunks")
+    return True
+
+
+@prex
+def draw_stats(text: str):
+    """Draws `text` in the top-left corner of the canvas."""
+    ctx = G.H.ctx
+    ctx.fillStyle = "rgba(0, 0, 0, 0.6)"
+    ctx.fillRect(0, 0, 8 + 7 * len(text), 22)
+    ctx.font = '12px monospace'
+    ctx.fillStyle = 'white'
+    ctx.textAlign = 'left'
+    ctx.fillText(text, 4, 15)
 
 
 @prex
@@ -429,38 +908,95 @@ async def read_text(filename: str) -> str:
         return Path(filename).read_text()
 
 
+@prex
+async def read_range(filename: str, start: int, length: int) -> bytes:
+    """`length` bytes of a file from `start`: with an HTTP Range request in a browser
+    (slicing the whole file if the server doesn't do ranges), otherwise from the file.
+    >>> asyncio.run(read_range(__file__, 7, 7))
+    b'asyncio'
+    """
+    try:
+        from pyodide.http import pyfetch  # type: ignore
+    except ModuleNotFoundError:
+        pyfetch = None
+    if pyfetch:
+        response = await pyfetch(filename, headers={"Range": f"bytes={start}-{start + length - 1}"})
+        if not response.ok:
+            raise FileNotFoundError(f"Failed to load {filename} (status {response.status})")
+        data = await response.bytes()
+        return data if response.status == 206 else data[start:start + length]
+    else:
+        with open(filename, "rb") as f:
+            f.seek(start)
+            return f.read(length)
+
+
+def map_entity(char: str, xidx: int, yidx: int, static: "dict[str, Entity]", dynamic: "dict[str, Entity]") -> bool:
+    """Add the entity for map character `char` at tile (xidx, yidx), if there is one,
+    to `static` or `dynamic`. Returns whether it's static (so blocks the tile)."""
+    if char == "w":
+        static[f"wall{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/brick2.png", False)
+    if char == "r":
+        static[f"ruin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/ruins.png", False)
+    elif char == "t":
+        static[f"tree{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/tree.png", False)
+    elif char == "c":
+        dynamic[f"coin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/coin.png", True)
+    elif char == "n":
+        dynamic[f"npcr2{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/officer.png", False, available_missions=[27, 29])
+    elif char == "👮":
+        dynamic[f"npcr1{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/alienBlue_front.png", False, available_missions=[23, 25])
+    return char in "wrt"
+
+
 @prex
 async def load_map(filename: str):
-    text = await read_text(filename)
-    lines = text.splitlines()
+    """Returns `(static, dynamic, blocked, grid)`: dicts of entities, the `Occupancy`
+    of the impassable ones, and an `EntityGrid` of the dynamic ones.
+    >>> static, dynamic, blocked, grid = asyncio.run(load_map("map.txt"))
+    >>> len(dynamic) > 10, len(grid.query(0, 0, 1000, 1000)) < len(dynamic)
+    (True, True)
+
+    A chunked map (see `MapStream`) has no static entities up front;
+    they're loaded as the player moves, and `blocked` is the `MapStream`.
+    """
     static = {}
     dynamic = {}
-
-    yindexes = range(-10, len(lines))
-    for yidx, line in zip(yindexes, lines):
-        xindexes = range(-10, len(line))
-        for xidx, char in zip(xindexes, line):
-            if char == "w":
-                static[f"wall{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/brick2.png", False)
-            if char == "r":
-                static[f"ruin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/ruins.png", False)
-            elif char == "t":
-                static[f"tree{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/tree.png", False)
-            elif char == "c":
-                dynamic[f"coin{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/coin.png", True)
-            elif char == "n":
-                dynamic[f"npcr2{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/officer.png", False, available_missions=[27, 29])
-            elif char == "👮":
-                dynamic[f"npcr1{xidx},{yidx}"] = Entity(50*xidx, 50*yidx, "", "/assets/alienBlue_front.png", False, available_missions=[23, 25])
-    return static, dynamic
+    stream = await MapStream.open(filename)
+    if stream is not None:
+        blocked: "Occupancy | MapStream" = stream
+        for char, xidx, yidx in stream.dynamic:
+            map_entity(char, xidx, yidx, static, dynamic)
+    else:
+        lines = (await read_text(filename)).splitlines()
+        blocked = Occupancy(-10, -10, max(map(len, lines), default=0), len(lines))
+        yindexes = range(-10, len(lines))
+        for yidx, line in zip(yindexes, lines):
+            xindexes = range(-10, len(line))
+            for xidx, char in zip(xindexes, line):
+                if map_entity(char, xidx, yidx, static, dynamic):
+                    blocked.block(50*xidx, 50*yidx)
+    grid = EntityGrid()
+    for e in dynamic.values():
+        grid.add(e)
+        if not e.passable:
+            blocked.block_box(e.x, e.y)
+    return static, dynamic, blocked, grid
 
 
 @prex
-async def draw_loop():
-    fps = 30
-    while True:
+def start_render_loop():
+    """Draws frames with `requestAnimationFrame`, so they line up with the display's
+    refresh and stop while the tab is hidden. Unchanged frames aren't redrawn."""
+    from pyodide.ffi import create_proxy  # type: ignore
+
+    def on_frame(timestamp):
         draw_one_frame()
-        await asyncio.sleep(1 / fps)
+        window.requestAnimationFrame(G.frame_proxy)
+
+    if G.frame_proxy is None:
+        G.frame_proxy = create_proxy(on_frame)
+        window.requestAnimationFrame(G.frame_proxy)
 
 
 @prex